@@ -0,0 +1,327 @@
+import asyncio
+import contextvars
+import json
+import math
+import os
+import time
+from collections import deque
+
+from fastapi.responses import JSONResponse
+
+import circuit_breaker
+import deadline
+import metrics
+import retries
+import structured_log
+from structured_log import get_logger
+
+log = get_logger("admission")
+
+# 每个上游 provider 同时进行的生成数上限；例如 ADMISSION_LIMITS='{"chatai": 8}'
+ADMISSION_LIMITS = {"chatai": 16, "openai": 64}
+ADMISSION_LIMITS.update(json.loads(os.getenv("ADMISSION_LIMITS", "{}")))
+# 排队上限与最长等待：队列满、或预计等待超过最长等待时立即拒绝，而不是排到超时
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+EWMA_ALPHA = 0.2
+
+GENERATE_PATHS = ("/generate", "/generate_stream", "/generate_batch")
+
+queue_depth = metrics.Gauge("colive_admission_queue_depth", "Requests waiting for an upstream slot", ("backend",))
+active_slots = metrics.Gauge("colive_admission_active", "Generations holding an upstream slot", ("backend",))
+wait_seconds = metrics.Histogram("colive_admission_wait_seconds", "Time spent waiting for an upstream slot", ("backend",))
+rejected_total = metrics.Counter("colive_admission_rejected_total", "Requests rejected by admission control", ("backend", "reason"))
+
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# 单个 provider 的并发闸门：最多 limit 个生成同时进行，其余按先来先到排队；
+#   释放时直接把名额交给队首，不会被新请求插队
+class BackendGate:
+    def __init__(self, name, limit, max_queue=ADMISSION_MAX_QUEUE):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.service_time = None  # 每次占用时长的 EWMA，用于估计等待时间
+        self._waiters = deque()
+
+    # 排在第 position 位时的预计等待（秒）；没有样本时返回 0
+    def expected_wait(self, position):
+        if self.service_time is None:
+            return 0.0
+        return self.service_time * math.ceil(position / self.limit)
+
+    def retry_after(self):
+        return max(1, math.ceil(self.expected_wait(len(self._waiters) + 1)))
+
+    async def acquire(self, max_wait):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            active_slots.set(self.active, self.name)
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise Rejected(503, "queue_full", self.retry_after())
+        if self.expected_wait(len(self._waiters) + 1) > max_wait:
+            raise Rejected(503, "deadline", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        queue_depth.set(len(self._waiters), self.name)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), max_wait)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # 名额刚好交到手上却不再需要，继续交给下一个
+                self.release(None)
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+                queue_depth.set(len(self._waiters), self.name)
+            if isinstance(e, asyncio.TimeoutError):
+                raise Rejected(503, "timeout", self.retry_after()) from None
+            raise
+        finally:
+            wait_seconds.observe(time.monotonic() - start, self.name)
+
+    # held: 本次占用时长（秒），None 表示没有真正使用
+    def release(self, held):
+        if held is not None:
+            self.service_time = held if self.service_time is None else self.service_time + EWMA_ALPHA * (held - self.service_time)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            queue_depth.set(len(self._waiters), self.name)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+        active_slots.set(self.active, self.name)
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": len(self._waiters),
+            "service_time": self.service_time,
+        }
+
+
+# 本次请求的 session_id（请求体中的 session_id 字段），由 AdmissionMiddleware 设置
+_session = contextvars.ContextVar("admission_session", default=None)
+
+
+# 请求结束后仍在运行的后台生成（如预测性生成）：不受触发它的请求的截止时间与会话限制约束
+def background_context():
+    context = deadline.detached_context()
+    context.run(_session.set, None)
+    return context
+
+
+# 流式响应的包装：上游的流读完、出错或被关闭时调用一次 on_close(completed)
+class ReleasingStream:
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._release(True)
+            raise
+        except BaseException:
+            self._release(False)
+            raise
+
+    async def close(self):
+        try:
+            await self._stream.close()
+        finally:
+            self._release(False)
+
+    def _release(self, completed):
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close(completed)
+
+
+# 准入控制：每个 provider 一个闸门，每个 session 同时只允许一个生成
+class AdmissionController:
+    def __init__(self, limits):
+        self.gates = {name: BackendGate(name, limit) for name, limit in limits.items()}
+        self._sessions = set()
+        self.rejected = 0
+
+    def gate(self, provider):
+        gate = self.gates.get(provider)
+        if gate is None:
+            gate = self.gates[provider] = BackendGate(provider, ADMISSION_LIMITS.get(provider, 16))
+        return gate
+
+    # 在实际调用的 provider 的名额内执行一次上游调用（fn 为无参协程函数），拿不到名额时抛 Rejected；
+    #   非流式调用返回即归还名额，流式调用占用到流读完或关闭。排队时间受请求的截止时间限制
+    #   只有正常完成的调用计入占用时长的估计，取消（客户端断开、对冲落败）和出错的不计
+    async def call(self, provider, fn, stream=False):
+        gate = self.gate(provider)
+        budget = deadline.remaining()
+        try:
+            await gate.acquire(ADMISSION_MAX_WAIT if budget is None else min(ADMISSION_MAX_WAIT, budget))
+        except Rejected as e:
+            self.rejected += 1
+            rejected_total.inc(provider, e.reason)
+            log.warning("admission_rejected", backend=provider, reason=e.reason, retry_after=e.retry_after)
+            raise
+        start = time.monotonic()
+        try:
+            result = await fn()
+        except BaseException:
+            gate.release(None)
+            raise
+        if not stream:
+            gate.release(time.monotonic() - start)
+            return result
+        return ReleasingStream(result, lambda completed: gate.release(time.monotonic() - start if completed else None))
+
+    # 本次请求所属的会话已有生成在进行时返回 429；由路由层在单飞合并之后调用，
+    #   被合并的重复请求（双击、重试）等待同一个结果，不经过这里
+    def claim_session(self, provider):
+        session_id = _session.get()
+        if session_id is None:
+            return None
+        if session_id in self._sessions:
+            self.rejected += 1
+            rejected_total.inc(provider, "session_busy")
+            log.warning("admission_rejected", backend=provider, reason="session_busy")
+            raise Rejected(429, "session_busy", max(1, math.ceil(self.gate(provider).service_time or 1)))
+        self._sessions.add(session_id)
+        return session_id
+
+    def release_session(self, session_id):
+        if session_id is not None:
+            self._sessions.discard(session_id)
+
+    def stats(self):
+        return {
+            "rejected": self.rejected,
+            "sessions_in_flight": len(self._sessions),
+            "backends": {name: gate.stats() for name, gate in self.gates.items()},
+        }
+
+
+admission = AdmissionController(ADMISSION_LIMITS)
+
+
+# 上游不可用的错误（名额不足、熔断器打开、重试后仍然失败的可重试错误）：返回 (状态码, 原因, Retry-After 秒数)，其他错误返回 None
+def unavailable(exc):
+    if isinstance(exc, Rejected):
+        return exc.status, exc.reason, exc.retry_after
+    if isinstance(exc, circuit_breaker.CircuitOpen):
+        return 503, "circuit_open", exc.retry_after
+    reason = retries.classify(exc)
+    if reason is None:
+        return None
+    return 503, reason, max(1, math.ceil(retries.retry_after(exc) or 1))
+
+
+def busy_response(status, reason, retry_after):
+    return JSONResponse(
+        {"detail": f"upstream busy ({reason}), retry later"},
+        status_code=status,
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+# ASGI 中间件：生成类接口的请求上下文与错误映射。上游名额在实际调用时按 provider 取得（见 AdmissionController.call），
+#   同一会话的并发生成由路由层检查（见 claim_session）；拿不到名额、熔断或重试耗尽时，响应还没开始就返回 429 / 503 + Retry-After
+#   请求体中的 session_id 记为本次请求的会话，X-Colive-Deadline-Ms 请求头转成本次请求的截止时间（见 deadline）
+#   客户端断开（排队中或生成中）时取消本次请求，上游调用随之取消，名额立即释放
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].endswith(GENERATE_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        body = await self._read_body(receive)
+        try:
+            session_id = json.loads(body).get("session_id")
+        except (ValueError, AttributeError):
+            session_id = None
+
+        task = asyncio.current_task()
+        disconnected = asyncio.Event()
+        response_started = False
+        response_done = False
+
+        # 请求体已读完，之后 receive 只会收到 http.disconnect
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+            if not response_done:
+                task.cancel()
+
+        async def app_receive():
+            nonlocal body
+            if body is not None:
+                chunk, body = body, None
+                return {"type": "http.request", "body": chunk, "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def app_send(message):
+            nonlocal response_started, response_done
+            if message["type"] == "http.response.start":
+                response_started = True
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                response_done = True
+            await send(message)
+
+        deadline_token = deadline.start(scope["headers"])
+        session_token = _session.set(session_id)
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            await self.app(scope, app_receive, app_send)
+        except asyncio.CancelledError:
+            if not disconnected.is_set():
+                raise
+            task.uncancel()
+            structured_log.annotate(disconnected=True)
+            log.info("client_disconnected", stage="streaming" if response_started else "generating")
+        except Exception as e:
+            # 上游不可用：响应还没开始时返回 429 / 503 + Retry-After，而不是未处理的 500（流式接口见 streaming.sse_response）
+            error = unavailable(e)
+            if error is None or response_started:
+                raise
+            status, reason, retry_after = error
+            if not isinstance(e, Rejected):
+                log.warning("upstream_unavailable", reason=reason, error=repr(e))
+            await busy_response(status, reason, retry_after)(scope, receive, send)
+        finally:
+            watcher.cancel()
+            deadline.reset(deadline_token)
+            _session.reset(session_token)
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
@@ -0,0 +1,127 @@
+import os
+
+import admission
+import deadline
+import output_schema
+from json_extract import JsonArrayStreamParser
+import metrics
+from model_router import model_router
+from streaming import STREAM_ERRORS, sse_event
+from structured_log import get_logger
+from usage_stats import usage_stats
+
+log = get_logger("autotalk_batch")
+
+MAX_BATCH_TURNS = int(os.getenv("AUTOTALK_MAX_BATCH_TURNS", "12"))
+
+# 追加在单轮 prompt 之后，把"只生成一条"放宽为按固定顺序生成多轮
+BATCH_INSTRUCTION = """
+Batch mode: instead of a single reply, continue the fixed speaking cycle for the next {count} turns:
+{schedule}
+Output one JSON array with exactly {count} items, in this order, one item per turn.
+Each item must be spoken only by that turn's speaker and may react to the items before it.
+Use the same item format as above.
+"""
+
+
+# 接下来 count 轮的 (turn_id, 发言者)
+def batch_schedule(avatars, turn_id, count):
+    return [(turn_id + i, avatars[(turn_id + i) % len(avatars)]) for i in range(count)]
+
+
+def utterance_line(item):
+    return f"{item.get('speaker')}: {item.get('text')}"
+
+
+# 依次产出 (turn_id, 发言)：先用一次多轮流式补全生成，每条发言到达即经 output_schema 校验（发言者须与该轮一致）；
+#   一旦出现顺序不符或输出提前结束，剩余轮次改为逐轮调用（同样只接受该轮发言者）
+#   build_messages / complete / fallback 为各 autotalk 服务器自己的实现
+#   请求带截止时间时，到时停止生成，已完成的轮次照常返回；一轮都没有时由第一轮发言者说一句占位的话
+#   上游不可用（名额不足、熔断、重试耗尽）时同样返回已完成的轮次；一轮都没有时抛出，由 AdmissionMiddleware 返回 503
+async def batch_turns(dialogue, count, build_messages, complete, fallback, provider, params, variant):
+    produced = 0
+    try:
+        async for turn_id, item in _generate_turns(dialogue, count, build_messages, complete, fallback, provider, params, variant):
+            produced += 1
+            yield turn_id, item
+    except deadline.DeadlineExceeded:
+        if not produced:
+            turn_id, speaker = batch_schedule(dialogue.avatars, dialogue.turn_id, 1)[0]
+            yield turn_id, deadline.stall_reply([speaker])[0]
+    except Exception as e:
+        if not produced or admission.unavailable(e) is None:
+            raise
+        log.warning("batch_interrupted", produced=produced, error=repr(e))
+
+
+async def _generate_turns(dialogue, count, build_messages, complete, fallback, provider, params, variant):
+    schedule = batch_schedule(dialogue.avatars, dialogue.turn_id, count)
+    history = list(dialogue.history)
+    done = 0
+
+    if count > 1:
+        instruction = BATCH_INSTRUCTION.format(
+            count=count,
+            schedule="\n".join(f"- Turn {turn_id}: {speaker}" for turn_id, speaker in schedule),
+        )
+        messages = build_messages(dialogue) + [{"role": "system", "content": instruction}]
+        multi_params = output_schema.completion_params(
+            {**params, "max_tokens": params["max_tokens"] * count},
+            list(dict.fromkeys(speaker for _, speaker in schedule)),
+        )
+        parser = JsonArrayStreamParser()
+        check = output_schema.ReplyCheck([])
+        multi_provider, multi_params = deadline.plan(provider, multi_params, model_router.alternates(params["model"], True))
+        stream = await deadline.within(model_router.complete(
+            multi_provider, None, messages=messages, stream=True, stream_options={"include_usage": True}, **multi_params
+        ))
+        diverged = False
+        try:
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await deadline.within(chunks.__anext__())
+                except StopAsyncIteration:
+                    break
+                except STREAM_ERRORS as e:
+                    # 多轮输出中途断开：剩余轮次逐轮生成
+                    log.warning("upstream_stream_interrupted", error=repr(e), done=done)
+                    break
+                if chunk.usage is not None:
+                    usage_stats.record(variant, params["model"], chunk.usage)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                for item in parser.feed(chunk.choices[0].delta.content):
+                    item = check.check(item, [schedule[done][1]]) if done < count else None
+                    if item is None:
+                        diverged = True
+                        break
+                    history.append(utterance_line(item))
+                    yield schedule[done][0], item
+                    done += 1
+                if diverged:
+                    break
+        finally:
+            await stream.close()
+        output_schema.output_stats.record(variant, params["model"], check.status(), check)
+
+    for turn_id, speaker in schedule[done:]:
+        turn_dialogue = dialogue.model_copy(update={"history": list(history), "turn_id": turn_id})
+        response = await complete(build_messages(turn_dialogue), speaker)
+        items = output_schema.validate_reply(response.choices[0].message.content, [speaker], variant, params["model"])
+        if not items:
+            metrics.fallbacks_total.inc(variant, params["model"])
+            items = fallback(speaker)
+        item = items[0]
+        history.append(utterance_line(item))
+        yield turn_id, item
+
+
+# 每轮完成即推送一个 turn 事件，最后的 done 事件携带全部轮次
+async def sse_turns(turns):
+    collected = []
+    async for turn_id, item in turns:
+        turn = {"turn_id": turn_id, "dialogue": [item]}
+        collected.append(turn)
+        yield sse_event("turn", turn)
+    yield sse_event("done", {"turns": collected})
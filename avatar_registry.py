@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+
+from lifespan import on_shutdown, on_startup
+from structured_log import get_logger
+
+log = get_logger("avatars")
+
+
+class PersonalityTraits(BaseModel):
+    Openness: int
+    Conscientiousness: int
+    Extraversion: int
+    Agreeableness: int
+    Neuroticism: int
+
+
+class StanceOnHouseRules(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    for_: List[str] = Field(alias="for")
+    against: List[str]
+
+
+# avatars.json 中单个角色卡的结构
+class Avatar(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    name: str
+    age: int
+    gender: str
+    occupation: Optional[str] = None  # avatars.json 目前没有该字段
+    personality_traits: PersonalityTraits
+    personality_description: str
+    lifestyle_log: str
+    hidden_motivation: str
+    stance_on_house_rules: StanceOnHouseRules
+
+
+_avatar_file = TypeAdapter(Dict[str, Avatar])
+
+
+# 进程内共享的角色注册表：启动时加载一次，文件 mtime 变化时后台热加载
+class AvatarRegistry:
+    def __init__(self, path, poll_interval=2.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.avatars = {}
+        self.mtime = None
+        self.version = 0
+        self._listeners = []
+        self._watch_task = None
+
+    # 读取并校验 avatars.json（可在线程中执行）
+    def _read(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, "r", encoding="utf-8") as f:
+            avatars = _avatar_file.validate_python(json.load(f))
+        for key, avatar in avatars.items():
+            if key != avatar.name:
+                raise ValueError(f"avatars.json: key {key!r} does not match name {avatar.name!r}")
+        return avatars, mtime
+
+    # 整体替换字典引用，然后通知监听者
+    def _apply(self, avatars, mtime):
+        self.avatars = avatars
+        self.mtime = mtime
+        self.version += 1
+        for listener in self._listeners:
+            listener()
+
+    def load(self):
+        self._apply(*self._read())
+
+    # 注册热加载回调（例如清空依赖角色卡的缓存）
+    def add_reload_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _ensure_loaded(self):
+        if self.mtime is None:
+            self.load()
+
+    def get(self, name):
+        self._ensure_loaded()
+        return self.avatars[name]
+
+    # 与原 load_avatar_data 相同：只返回存在的角色
+    def get_many(self, names):
+        self._ensure_loaded()
+        avatars = self.avatars
+        return {name: avatars[name] for name in names if name in avatars}
+
+    async def _watch(self):
+        failed_mtime = None
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            mtime = None
+            try:
+                mtime = (await asyncio.to_thread(os.stat, self.path)).st_mtime
+                if mtime in (self.mtime, failed_mtime):
+                    continue
+                # 解析放到线程里，替换在事件循环上完成，请求不会被阻塞
+                self._apply(*(await asyncio.to_thread(self._read)))
+                log.info("avatars_reloaded", path=self.path, version=self.version)
+            except (OSError, ValueError, ValidationError) as e:
+                failed_mtime = mtime
+                log.error("avatars_reload_failed", path=self.path, version=self.version, error=repr(e))
+
+    async def start(self):
+        if self.mtime is None:
+            self._apply(*(await asyncio.to_thread(self._read)))
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+
+registry = AvatarRegistry(
+    os.getenv("AVATARS_PATH", "avatars.json"),
+    poll_interval=float(os.getenv("AVATARS_POLL_INTERVAL", "2.0")),
+)
+on_startup(registry.start)
+on_shutdown(registry.stop)
@@ -0,0 +1,33 @@
+import contextvars
+import json
+import os
+
+# 后端注册表：模型 -> 所在 provider（llm_client.PROVIDERS 的名称）
+# 例如 COLIVE_MODELS='{"gpt-4o-mini": "openai"}' 可追加新模型
+MODELS = {
+    "gpt-4o": "openai",
+    "meta-llama-3.1-8b-instruct": "chatai",
+    "qwen3-32b": "chatai",
+}
+MODELS.update(json.loads(os.getenv("COLIVE_MODELS", "{}")))
+
+# 当前请求指定的模型（由 colive_unified 根据请求头设置），None 表示使用 variant 的默认模型
+_model_override = contextvars.ContextVar("model_override", default=None)
+
+
+def set_model_override(model):
+    if model not in MODELS:
+        raise KeyError(model)
+    return _model_override.set(model)
+
+
+def reset_model_override(token):
+    _model_override.reset(token)
+
+
+# 返回本次请求实际使用的 (provider, 补全参数)
+def resolve(provider, params):
+    model = _model_override.get()
+    if model is None or model == params["model"]:
+        return provider, params
+    return MODELS[model], {**params, "model": model}
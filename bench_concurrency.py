@@ -0,0 +1,74 @@
+"""
+并发吞吐对比：同步 OpenAI 客户端（旧写法） vs 共享 AsyncOpenAI 连接池（llm_client）。
+
+本地启动一个模拟上游（固定延迟），然后在同一个事件循环里并发发起 N 个
+/generate 风格的调用，分别统计总耗时与吞吐。
+
+用法:
+    python bench_concurrency.py --concurrency 100 --latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from openai import OpenAI
+
+from mock_llm import MockConfig, MockLLM, serve_in_thread
+
+MESSAGES = [{"role": "system", "content": "bench"}, {"role": "user", "content": "hi"}]
+
+
+async def run_sync_client(base_url, concurrency):
+    client = OpenAI(api_key="bench", base_url=base_url)
+
+    # 与改造前的 handler 相同：async def 内部调用同步客户端
+    async def handler():
+        response = client.chat.completions.create(model="stub", messages=MESSAGES, max_tokens=250)
+        return response.choices[0].message.content
+
+    await asyncio.gather(*(handler() for _ in range(concurrency)))
+    client.close()
+
+
+async def run_async_client(base_url, concurrency):
+    import llm_client
+
+    async def handler():
+        response = await llm_client.chat_completion("chatai", model="stub", messages=MESSAGES, max_tokens=250)
+        return response.choices[0].message.content
+
+    await asyncio.gather(*(handler() for _ in range(concurrency)))
+    await llm_client.aclose()
+
+
+def report(label, concurrency, elapsed):
+    print(f"{label:<28} {concurrency:>6} req  {elapsed:>8.2f} s  {concurrency / elapsed:>9.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.5, help="模拟上游每次补全的延迟（秒）")
+    args = parser.parse_args()
+
+    server, url = serve_in_thread(MockLLM(MockConfig(latency="fixed", latency_mean=args.latency)).build_app())
+    base_url = f"{url}/v1"
+    os.environ["CHATAI_API_KEY"] = "bench"
+    os.environ["CHATAI_BASE_URL"] = base_url
+
+    print(f"upstream latency {args.latency:.2f} s, concurrency {args.concurrency}")
+
+    start = time.perf_counter()
+    asyncio.run(run_sync_client(base_url, args.concurrency))
+    report("before (sync client)", args.concurrency, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    asyncio.run(run_async_client(base_url, args.concurrency))
+    report("after (shared async pool)", args.concurrency, time.perf_counter() - start)
+
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
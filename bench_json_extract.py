@@ -0,0 +1,147 @@
+"""
+模型输出解析对比：json.loads（旧写法） vs json_extract 容错提取。
+
+语料以 logs/*.jsonl 中记录的回复为种子（没有日志时用 mock_llm 的台词生成），
+按线上见过的几类畸形输出做变异：```json 包裹、前言、尾逗号、截断、
+命中 stop 序列（qwen 的 "\\n\\n"）、结构化输出外层等；统计每类能救回的发言比例，
+并用不同长度的输入检查提取耗时是否线性增长。
+
+用法:
+    python bench_json_extract.py --log-dir logs --samples 500
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+from json_extract import extract_dialogue
+from mock_llm import CANNED_TEXTS, EMOTIONS, GESTURES
+
+
+def load_seeds(log_dir):
+    seeds = []
+    for path in sorted(glob.glob(os.path.join(log_dir, "*.jsonl"))):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    response = json.loads(line).get("response")
+                except (json.JSONDecodeError, AttributeError):
+                    continue
+                turns = [turn for turn in response or [] if isinstance(turn, dict) and "speaker" in turn and "text" in turn]
+                if turns:
+                    seeds.append(turns)
+    return seeds
+
+
+def synthetic_seeds(rng, count):
+    return [
+        [
+            {
+                "speaker": speaker,
+                "text": rng.choice(CANNED_TEXTS),
+                "emotion": rng.choice(EMOTIONS),
+                "gesture": rng.choice(GESTURES),
+            }
+            for speaker in rng.sample(["Alice", "Benji", "Caden"], rng.randint(1, 3))
+        ]
+        for _ in range(count)
+    ]
+
+
+def dumps(turns, **kwargs):
+    return json.dumps(turns, ensure_ascii=False, **kwargs)
+
+
+def truncate(rng, text):
+    return text[:rng.randint(len(text) // 3, len(text) - 1)]
+
+
+# 变异方式：(名称, 函数(rng, turns) -> 原始回复)
+MUTATIONS = [
+    ("clean", lambda rng, turns: dumps(turns)),
+    ("pretty", lambda rng, turns: dumps(turns, indent=2)),
+    ("markdown", lambda rng, turns: f"```json\n{dumps(turns, indent=2)}\n```"),
+    ("preamble", lambda rng, turns: f"Sure! Here is the next part of the conversation [JSON]:\n{dumps(turns)}"),
+    ("trailing_comma", lambda rng, turns: "[" + ", ".join(dumps(turn)[:-1] + ",}" for turn in turns) + ",]"),
+    ("wrapper", lambda rng, turns: dumps({"dialogue": turns})),
+    ("truncated", lambda rng, turns: truncate(rng, dumps(turns))),
+    ("markdown_truncated", lambda rng, turns: truncate(rng, f"```json\n{dumps(turns, indent=2)}\n```")),
+    ("stop_sequence", lambda rng, turns: ("[\n" + ",\n\n".join(dumps(turn) for turn in turns) + "\n]").split("\n\n")[0]),
+]
+
+
+def strict_parse(raw):
+    try:
+        data = json.loads(raw.strip())
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, list) else None
+
+
+# 按位置比对 speaker + text，完全一致才算救回
+def recovered(turns, items):
+    if not items:
+        return 0
+    return sum(
+        1 for turn, item in zip(turns, items)
+        if isinstance(item, dict) and item.get("speaker") == turn["speaker"] and item.get("text") == turn["text"]
+    )
+
+
+def run_corpus(seeds, samples, seed):
+    rng = random.Random(seed)
+    print(f"{'mutation':<20} {'samples':>8} {'utterances':>11} {'json.loads':>11} {'extract':>9} {'failed':>8}")
+    total_bytes = 0
+    total_time = 0.0
+    for name, mutate in MUTATIONS:
+        utterances = strict_ok = extract_ok = failed = 0
+        for _ in range(samples):
+            turns = rng.choice(seeds)
+            raw = mutate(rng, turns)
+            utterances += len(turns)
+            strict_ok += recovered(turns, strict_parse(raw))
+            start = time.perf_counter()
+            items = extract_dialogue(raw)
+            total_time += time.perf_counter() - start
+            total_bytes += len(raw)
+            salvaged = recovered(turns, items)
+            extract_ok += salvaged
+            failed += salvaged == 0
+        print(f"{name:<20} {samples:>8} {utterances:>11} {strict_ok / utterances:>10.1%} {extract_ok / utterances:>8.1%} {failed:>8}")
+    print(f"\nextract throughput: {total_bytes / total_time / 1e6:.1f} MB/s")
+
+
+# 同一条发言重复 n 次，耗时 / 字节数应大致不变
+def run_scaling(seeds, sizes):
+    turn = seeds[0][0]
+    print(f"\n{'utterances':>10} {'bytes':>10} {'ms':>9} {'ns/byte':>9}")
+    for size in sizes:
+        raw = "```json\n" + dumps([turn] * size, indent=2)[:-3]
+        start = time.perf_counter()
+        items = extract_dialogue(raw)
+        elapsed = time.perf_counter() - start
+        print(f"{size:>10} {len(raw):>10} {elapsed * 1e3:>9.2f} {elapsed / len(raw) * 1e9:>9.1f}   ({len(items)} extracted)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-dir", default="logs", help="会话日志目录，作为语料种子")
+    parser.add_argument("--samples", type=int, default=500, help="每种变异的样本数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    args = parser.parse_args()
+
+    seeds = load_seeds(args.log_dir)
+    print(f"{len(seeds)} logged replies from {args.log_dir}")
+    if not seeds:
+        seeds = synthetic_seeds(random.Random(args.seed), 200)
+        print(f"no logged replies, using {len(seeds)} synthetic ones")
+
+    run_corpus(seeds, args.samples, args.seed)
+    run_scaling(seeds, args.sizes)
+
+
+if __name__ == "__main__":
+    main()
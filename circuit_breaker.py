@@ -0,0 +1,173 @@
+import json
+import math
+import os
+import time
+from collections import deque
+
+import backends
+import metrics
+import output_schema
+import retries
+from structured_log import get_logger
+
+log = get_logger("breaker")
+
+# 统计窗口（秒）与最少请求数：窗口内请求不足时不打开
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "30"))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "10"))
+# 窗口内失败率或慢调用率超过阈值时打开；失败指可重试的上游错误（429 / 5xx / 超时 / 连接错误）
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.8"))
+BREAKER_SLOW_SECONDS = float(os.getenv("BREAKER_SLOW_SECONDS", "15"))
+# 打开后的冷却时间；半开探测失败时翻倍，直到上限
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "10"))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv("BREAKER_MAX_OPEN_SECONDS", "120"))
+# 半开时同时放行的探测请求数，连续成功这么多次后关闭
+BREAKER_PROBES = int(os.getenv("BREAKER_PROBES", "2"))
+BREAKER_CLOSE_AFTER = int(os.getenv("BREAKER_CLOSE_AFTER", "3"))
+# 打开期间改用的备用模型（按 provider 配置），例如 BREAKER_FALLBACKS='{"chatai": "gpt-4o"}'；未配置时直接快速失败
+BREAKER_FALLBACKS = json.loads(os.getenv("BREAKER_FALLBACKS", "{}"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+state_gauge = metrics.Gauge("colive_circuit_state", "Circuit breaker state per backend (0 closed, 1 half-open, 2 open)", ("backend",))
+transitions_total = metrics.Counter("colive_circuit_transitions_total", "Circuit breaker state changes", ("backend", "state"))
+rejected_total = metrics.Counter("colive_circuit_rejected_total", "Upstream calls failed fast by an open circuit", ("backend",))
+diverted_total = metrics.Counter("colive_circuit_diverted_total", "Requests diverted to the fallback model while the circuit is open", ("backend", "model"))
+
+
+class CircuitOpen(Exception):
+    def __init__(self, backend, retry_after):
+        super().__init__(f"circuit open for {backend}")
+        self.backend = backend
+        self.retry_after = retry_after
+
+
+# 单个上游 provider 的熔断器：closed 时统计窗口内的失败率 / 慢调用率，超过阈值转为 open；
+#   open 期间直接失败，冷却后转为 half_open，只放行少量探测请求，连续成功后关闭，失败则重新打开
+class CircuitBreaker:
+    def __init__(self, backend):
+        self.backend = backend
+        self.state = CLOSED
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.opened_at = 0.0
+        self.probes = 0  # 半开时进行中的探测请求
+        self.probe_successes = 0
+        self._outcomes = deque()  # (时间, 失败, 慢调用)
+        state_gauge.set(0, backend)
+
+    def _transition(self, state):
+        self.state = state
+        state_gauge.set(STATE_VALUES[state], self.backend)
+        transitions_total.inc(self.backend, state)
+        log.warning("circuit_" + state, backend=self.backend, open_seconds=self.open_seconds)
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self.probe_successes = 0
+        self._outcomes.clear()
+        self._transition(OPEN)
+
+    def retry_after(self):
+        return max(1, math.ceil(self.opened_at + self.open_seconds - time.monotonic()))
+
+    # 现在是否会放行请求（不占用探测名额）；冷却结束时转为 half_open
+    def available(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            return self.probes < BREAKER_PROBES
+        return self.state == CLOSED
+
+    # 调用前：放行返回 True（half_open 时占用一个探测名额），否则抛 CircuitOpen
+    def before_call(self):
+        if not self.available():
+            rejected_total.inc(self.backend)
+            raise CircuitOpen(self.backend, self.retry_after())
+        if self.state == HALF_OPEN:
+            self.probes += 1
+            return True
+        return False
+
+    def record(self, probe, failed, latency):
+        slow = latency > BREAKER_SLOW_SECONDS
+        if probe:
+            self.probes -= 1
+            if self.state != HALF_OPEN:
+                return
+            if failed or slow:
+                self.open_seconds = min(self.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+                self._open()
+                return
+            self.probe_successes += 1
+            if self.probe_successes >= BREAKER_CLOSE_AFTER:
+                self.open_seconds = BREAKER_OPEN_SECONDS
+                self._transition(CLOSED)
+            return
+        if self.state != CLOSED:
+            return
+
+        now = time.monotonic()
+        outcomes = self._outcomes
+        outcomes.append((now, failed, slow))
+        while outcomes and outcomes[0][0] < now - BREAKER_WINDOW:
+            outcomes.popleft()
+        total = len(outcomes)
+        if total < BREAKER_MIN_REQUESTS:
+            return
+        failures = sum(1 for _, f, _ in outcomes if f)
+        slow_calls = sum(1 for _, _, s in outcomes if s)
+        if failures / total >= BREAKER_ERROR_RATE or slow_calls / total >= BREAKER_SLOW_RATE:
+            self._open()
+
+    # 被取消的探测请求不计结果，只归还名额
+    def release(self, probe):
+        if probe:
+            self.probes -= 1
+
+    async def call(self, fn):
+        probe = self.before_call()
+        start = time.monotonic()
+        try:
+            result = await fn()
+        except Exception as e:
+            self.record(probe, retries.classify(e) is not None, time.monotonic() - start)
+            raise
+        except BaseException:
+            self.release(probe)
+            raise
+        self.record(probe, False, time.monotonic() - start)
+        return result
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "window_requests": len(self._outcomes),
+            "open_seconds": self.open_seconds,
+        }
+
+
+_breakers = {}
+
+
+def breaker(backend):
+    result = _breakers.get(backend)
+    if result is None:
+        result = _breakers[backend] = CircuitBreaker(backend)
+    return result
+
+
+# 打开期间改用配置的备用模型：返回 (provider, 参数)；没有配置、或备用模型的 provider 也不可用时原样返回
+def divert(provider, params):
+    if breaker(provider).available():
+        return provider, params
+    fallback = BREAKER_FALLBACKS.get(provider)
+    if fallback is None or fallback not in backends.MODELS or not breaker(backends.MODELS[fallback]).available():
+        return provider, params
+    diverted_total.inc(provider, fallback)
+    return backends.MODELS[fallback], output_schema.switch_model(params, fallback)
+
+
+def stats():
+    return {backend: item.stats() for backend, item in _breakers.items()}
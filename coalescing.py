@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import deadline
+import metrics
+from model_router import model_router
+from usage_stats import usage_stats
+
+
+# 单飞合并：同一 key 同时只有一个上游调用，其余请求等待它的结果；可选的短 TTL 结果缓存处理紧接着的重试
+class SingleFlight:
+    def __init__(self, ttl=0.0, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._inflight = {}  # key -> [Task, 等待者数量]
+        self._results = OrderedDict()  # key -> (结果, 过期时间)
+        self.calls = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    async def run(self, key, fn):
+        cached = self._results.get(key)
+        if cached is not None:
+            if cached[1] > time.monotonic():
+                self.cache_hits += 1
+                return cached[0]
+            del self._results[key]
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            self.calls += 1
+            task = asyncio.create_task(fn())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.coalesced += 1
+
+        # 某个等待者被取消不影响其他人；所有等待者都取消时才取消上游调用
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            entry[1] -= 1
+            if entry[1] == 0:
+                entry[0].cancel()
+            raise
+
+    def _finish(self, key, task):
+        self._inflight.pop(key, None)
+        if self.ttl <= 0 or task.cancelled() or task.exception() is not None:
+            return
+        self._results[key] = (task.result(), time.monotonic() + self.ttl)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "cache_hits": self.cache_hits,
+            "in_flight": len(self._inflight),
+        }
+
+
+coalescer = SingleFlight(
+    ttl=float(os.getenv("COALESCE_RESULT_TTL", "5")),
+    maxsize=int(os.getenv("COALESCE_CACHE_SIZE", "1024")),
+)
+
+
+# 请求指纹：完整的 messages + 模型 + 采样参数
+def request_key(provider, params):
+    payload = json.dumps([provider, params], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# 非流式补全经过单飞合并；流式请求直接交给路由层
+#   用量只由发起上游调用的一方记一次，等待者和缓存命中拿到的是同一份响应
+#   合并后的上游调用只有在所有等待者都取消（客户端断开、预生成过期、截止时间已到）时才会被取消，此时记一次取消
+#   请求带截止时间时按剩余预算调整 max_tokens / 模型，到时抛 deadline.DeadlineExceeded
+async def complete(provider, session_key, **params):
+    if params.get("stream"):
+        return await model_router.complete(provider, session_key, **params)
+
+    async def call():
+        planned_provider, planned = deadline.plan(provider, params, model_router.alternates(params["model"], False))
+        try:
+            response = await model_router.complete(planned_provider, session_key, **planned)
+        except asyncio.CancelledError:
+            usage_stats.record_cancelled(metrics.current_labels()[0], params["model"], max_tokens=planned.get("max_tokens"))
+            raise
+        usage_stats.record(metrics.current_labels()[0], params["model"], response.usage)
+        return response
+
+    with metrics.stage("upstream"):
+        return await deadline.within(coalescer.run(request_key(provider, params), call))
+
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "300"))
+IDEMPOTENCY_MAX = int(os.getenv("IDEMPOTENCY_MAX", "10000"))
+
+
+# Idempotency-Key 请求头：同一个 key 的重复请求直接重放第一次的响应（进行中的则等待它完成）
+#   只缓存完整发送的 2xx 响应；同一个 key 配不同请求体返回 422
+class IdempotencyMiddleware:
+    def __init__(self, app, ttl=IDEMPOTENCY_TTL, maxsize=IDEMPOTENCY_MAX):
+        self.app = app
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # (path, key) -> {"body_hash", "done", "messages", "expires"}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        idempotency_key = dict(scope["headers"]).get(IDEMPOTENCY_HEADER)
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+
+        body = await self._read_body(receive)
+        body_hash = hashlib.sha256(body).hexdigest()
+        key = (scope["path"], idempotency_key)
+        now = time.monotonic()
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if len(self._entries) <= self.maxsize and not (oldest["done"].is_set() and oldest["expires"] < now):
+                break
+            self._entries.popitem(last=False)
+
+        entry = self._entries.get(key)
+        if entry is not None and entry["done"].is_set() and entry["expires"] < now:
+            entry = None
+        if entry is not None:
+            if entry["body_hash"] != body_hash:
+                await self._send_error(send, 422, "Idempotency-Key was reused with a different request body")
+                return
+            await entry["done"].wait()
+            if entry["messages"] is not None:
+                for message in entry["messages"]:
+                    await send(message)
+                return
+            # 第一次请求失败：本次重新执行
+
+        entry = self._entries[key] = {"body_hash": body_hash, "done": asyncio.Event(), "messages": None, "expires": 0.0}
+        messages = []
+        status = 500
+        finished = False
+
+        async def capture(message):
+            nonlocal status, finished
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                finished = True
+            messages.append(message)
+            await send(message)
+
+        async def replay_receive():
+            nonlocal body
+            if body is not None:
+                chunk, body = body, None
+                return {"type": "http.request", "body": chunk, "more_body": False}
+            return await receive()
+
+        try:
+            await self.app(scope, replay_receive, capture)
+        finally:
+            if finished and 200 <= status < 300:
+                entry["messages"] = messages
+                entry["expires"] = time.monotonic() + self.ttl
+            else:
+                self._entries.pop(key, None)
+            entry["done"].set()
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def _send_error(send, status, detail):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -1,20 +1,39 @@
 from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import List
-import json
-import os
+from pydantic import BaseModel, Field
+from typing import List, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from openai import OpenAI
-
-client = OpenAI(
-    api_key=os.getenv("CHATAI_API_KEY"),
-    base_url="https://chat-ai.academiccloud.de/v1"
-)
-
-app = FastAPI()
+import backends
+import coalescing
+import deadline
+import metrics
+import structured_log
+from structured_log import get_logger
+from avatar_registry import registry
+import streaming
+import output_schema
+import autotalk_batch
+from prompt_cache import prompt_cache
+from history_manager import history_manager
+from speculation import SPECULATE, history_key, speculation
+from lifespan import lifespan
+import service
+
+app = FastAPI(lifespan=lifespan)
+
+VARIANT = "colive_autotalk_server_chatai"
+PROVIDER = "chatai"
+COMPLETION_PARAMS = {
+    "model": "meta-llama-3.1-8b-instruct",
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "max_tokens": 250,
+}
+service.install(app, VARIANT, PROVIDER, COMPLETION_PARAMS, extra_stats={"speculation": speculation.stats})
+
+log = get_logger(VARIANT)
 
 
 # 请求参数（当前history）
@@ -24,43 +43,50 @@ class DialogueRequest(BaseModel):
     avatars: List[str]
     participant_role: str
     turn_id: int  # 当前轮次索引
+    session_id: Optional[str] = None  # 可选；预测性生成按它区分会话，缺省时按下一轮请求的指纹区分
 
 
-# 加载角色档案
-def load_avatar_data(names):
-    with open("avatars.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return {name: data[name] for name in names if name in data}
+# 批量请求：从 turn_id 开始连续生成 turns 轮
+class BatchRequest(DialogueRequest):
+    turns: int = Field(3, ge=1, le=autotalk_batch.MAX_BATCH_TURNS)
+    stream: bool = False  # true 时每轮完成即以 SSE 推送
 
 
 # 讲角色卡格式化为gpt prompt格式
 def format_avatar_prompt(avatar):
     return (
-        f"Name: {avatar['name']}, Age: {avatar['age']}, Gender: {avatar['gender']}.\n"
+        f"Name: {avatar.name}, Age: {avatar.age}, Gender: {avatar.gender}.\n"
         f"Personality Traits (NEO-FFI-30 scale, 0–24):\n"
-        f"  - Openness: {avatar['personality_traits']['Openness']}\n"
-        f"  - Conscientiousness: {avatar['personality_traits']['Conscientiousness']}\n"
-        f"  - Extraversion: {avatar['personality_traits']['Extraversion']}\n"
-        f"  - Agreeableness: {avatar['personality_traits']['Agreeableness']}\n"
-        f"  - Neuroticism: {avatar['personality_traits']['Neuroticism']}\n"
-        f"{avatar['personality_description']}\n\n"
-        f"Lifestyle Log:\n{avatar['lifestyle_log']}\n\n"
-        f"Hidden Motivation (private, only known to {avatar['name']}):\n{avatar['hidden_motivation']}\n\n"
+        f"  - Openness: {avatar.personality_traits.Openness}\n"
+        f"  - Conscientiousness: {avatar.personality_traits.Conscientiousness}\n"
+        f"  - Extraversion: {avatar.personality_traits.Extraversion}\n"
+        f"  - Agreeableness: {avatar.personality_traits.Agreeableness}\n"
+        f"  - Neuroticism: {avatar.personality_traits.Neuroticism}\n"
+        f"{avatar.personality_description}\n\n"
+        f"Lifestyle Log:\n{avatar.lifestyle_log}\n\n"
+        f"Hidden Motivation (private, only known to {avatar.name}):\n{avatar.hidden_motivation}\n\n"
         f"Stance on House Rules:\n"
-        f"  - Supports: {', '.join(avatar['stance_on_house_rules']['for'])}\n"
-        f"  - Opposes: {', '.join(avatar['stance_on_house_rules']['against'])}\n"
+        f"  - Supports: {', '.join(avatar.stance_on_house_rules.for_)}\n"
+        f"  - Opposes: {', '.join(avatar.stance_on_house_rules.against)}\n"
     )
 
 
-@app.post("/generate")
-async def generate_response(dialogue: DialogueRequest):
-    avatar_infos = load_avatar_data(dialogue.avatars)
-    turn_id = dialogue.turn_id
-    avatar_count = len(dialogue.avatars)
-    current_speaker = dialogue.avatars[turn_id % avatar_count]
+# 模型输出不是合法 JSON 时，由本轮发言者给出占位回复
+def format_error_reply(current_speaker):
+    return [{
+        "speaker": current_speaker,
+        "text": "ChatAI response format error.",
+        "emotion": "neutral",
+        "gesture": "start talking"
+    }]
+
+
+# 构造 system prompt 的静态前缀：只依赖角色列表，所有轮次、发言者字节级一致，便于上游 prefix cache 命中
+def build_system_prompt(avatars):
+    avatar_infos = registry.get_many(avatars)
 
     persona_section = "\n---\n".join(
-        [format_avatar_prompt(avatar_infos[name]) for name in dialogue.avatars]
+        [format_avatar_prompt(avatar_infos[name]) for name in avatars]
     )
 
     system_prompt = f"""
@@ -78,9 +104,6 @@ async def generate_response(dialogue: DialogueRequest):
 
     Alice → Benji → Caden → Alice → ...
 
-    This is **Turn {turn_id}**, and it is now **{current_speaker}**'s turn to speak. 
-    Only generate a reply for {current_speaker}. The other avatars should remain silent in this turn.
-
     ---
     House Rules:
     Below are the current house rules being discussed in the retrospective. Avatars may agree, disagree, or suggest
@@ -223,20 +246,6 @@ async def generate_response(dialogue: DialogueRequest):
     Avoid overusing "start talking" if other expressive gestures are more fitting.
 
 
-    Output the dialogue in the following **structured JSON array format** with exactly one item:
-
-    [
-      {{
-        "speaker": "{current_speaker}",
-        "text": "..." ,
-        "emotion": "...",   // from: ["neutral", "happy", "cheerful", "frustrated", "calm", "hopeful", "angry", "sad",
-        "thinking"]
-        "gesture": "..."    // from the allowed gestures for this avatar
-      }}
-    ]
-
-    Ensure the style and behavior of the response match {current_speaker}'s personality and speaking style.
-    Do not include any narration, formatting, or responses from other avatars.
     
     Each avatar must speak in a way that clearly reflects their personality traits, lifestyle, and emotional tendencies:
 
@@ -264,33 +273,158 @@ async def generate_response(dialogue: DialogueRequest):
     
     """
 
+    return system_prompt
+
+
+# 构造 system prompt 的尾部：轮次与本轮发言者每轮都不同，放在最后
+def build_turn_tail(current_speaker, turn_id):
+    return f"""
+    ---
+    This is **Turn {turn_id}**, and it is now **{current_speaker}**'s turn to speak. 
+    Only generate a reply for {current_speaker}. The other avatars should remain silent in this turn.
+
+    Output the dialogue in the following **structured JSON array format** with exactly one item:
+
+    [
+      {{
+        "speaker": "{current_speaker}",
+        "text": "..." ,
+        "emotion": "...",   // from: ["neutral", "happy", "cheerful", "frustrated", "calm", "hopeful", "angry", "sad",
+        "thinking"]
+        "gesture": "..."    // from the allowed gestures for this avatar
+      }}
+    ]
+
+    Ensure the style and behavior of the response match {current_speaker}'s personality and speaking style.
+    Do not include any narration, formatting, or responses from other avatars.
+    """
+
+
+# 构造发送给模型的消息列表
+@metrics.timed("prompt")
+def build_messages(dialogue):
+    current_speaker = dialogue.avatars[dialogue.turn_id % len(dialogue.avatars)]
+    static_prompt = prompt_cache.get(
+        (VARIANT, tuple(dialogue.avatars)),
+        lambda: build_system_prompt(dialogue.avatars),
+    )
+    system_prompt = static_prompt + build_turn_tail(current_speaker, dialogue.turn_id)
+
     # 构造上下文
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    summary, recent_history = history_manager.window(dialogue.history, provider, params["model"])
     messages = [{"role": "system", "content": system_prompt}]
-    for msg in dialogue.history:
+    if summary:
+        messages.append({"role": "system", "content": summary})
+    for msg in recent_history:
         messages.append({"role": "user", "content": msg})
     messages.append({"role": "user", "content": "Please continue the conversation."})
 
-    # 调用 GPT
-    response = client.chat.completions.create(
-        model="meta-llama-3.1-8b-instruct",
-        messages=messages,
-        temperature=0.7,
-        top_p=0.9,
-        max_tokens=250,
+    return messages
+
+
+# 调用上游并记录用量；speaker 为本轮发言者（结构化输出只允许该 avatar）
+async def complete(messages, speaker):
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    params = output_schema.completion_params(params, [speaker])
+    return await coalescing.complete(provider, None, messages=messages, **params)
+
+
+# 预测结果的存放位置：有 session_id 时每个会话一个；旧客户端不带 session_id，
+#   以请求指纹本身作为标识，同一角色组合的并发会话互不覆盖（分叉的结果到期或被 LRU 淘汰）
+def speculation_session(dialogue, key):
+    _, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    return (VARIANT, params["model"], dialogue.session_id or key)
+
+
+# 本轮返回后在后台提前生成下一轮：发言者由 turn_id 决定，user 消息固定，只差本轮回复
+def speculate_next_turn(dialogue, reply):
+    if not SPECULATE or not isinstance(reply, list):
+        return
+    next_dialogue = dialogue.model_copy(update={
+        "history": dialogue.history + [f"{turn.get('speaker')}: {turn.get('text')}" for turn in reply if isinstance(turn, dict)],
+        "turn_id": dialogue.turn_id + 1,
+    })
+    next_speaker = next_dialogue.avatars[next_dialogue.turn_id % len(next_dialogue.avatars)]
+    key = history_key(next_dialogue.avatars, next_dialogue.turn_id, next_dialogue.history)
+    speculation.start(
+        speculation_session(dialogue, key),
+        key,
+        lambda: complete(build_messages(next_dialogue), next_speaker),
     )
 
+
+# 与本轮请求一致的预测结果（Task），没有或 history 已分叉时为 None
+def take_speculation(dialogue):
+    key = history_key(dialogue.avatars, dialogue.turn_id, dialogue.history)
+    return speculation.take(speculation_session(dialogue, key), key)
+
+
+# 主服务接口
+@app.post("/generate")
+async def generate_response(dialogue: DialogueRequest):
+    structured_log.annotate(session_id=dialogue.session_id)
+    current_speaker = dialogue.avatars[dialogue.turn_id % len(dialogue.avatars)]
+    response = None
+    speculative = take_speculation(dialogue)
+    if speculative is not None:
+        try:
+            response = await deadline.within(speculative)
+        except Exception as e:
+            log.warning("speculative_turn_failed", error=repr(e))
+
+    # 调用 GPT
+    if response is None:
+        try:
+            response = await complete(build_messages(dialogue), current_speaker)
+        except deadline.DeadlineExceeded:
+            # 截止时间前拿不到回复：由本轮发言者说一句占位的话
+            return {"dialogue": deadline.stall_reply([current_speaker])}
+
     raw_reply = response.choices[0].message.content
-    print("=== ChatAI RAW ===\n", raw_reply)
-
-    # 尝试解析 JSON 输出
-    try:
-        reply_json = json.loads(raw_reply.strip())
-    except json.JSONDecodeError:
-        reply_json = [{
-            "speaker": current_speaker,
-            "text": "ChatAI response format error.",
-            "emotion": "neutral",
-            "gesture": "start talking"
-        }]
+    structured_log.log_raw_reply(raw_reply)
+
+    # 解析并校验 JSON 输出：只接受本轮发言者，emotion / gesture 不合法时修正
+    _, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    reply_json = output_schema.validate_reply(raw_reply, [current_speaker], VARIANT, params["model"])
+    if not reply_json:
+        metrics.fallbacks_total.inc(VARIANT, params["model"])
+        reply_json = format_error_reply(current_speaker)
 
+    speculate_next_turn(dialogue, reply_json)
     return {"dialogue": reply_json}
+
+
+# 流式接口：发言一生成完就以 SSE 推送
+@app.post("/generate_stream")
+async def generate_stream(dialogue: DialogueRequest):
+    structured_log.annotate(session_id=dialogue.session_id)
+    current_speaker = dialogue.avatars[dialogue.turn_id % len(dialogue.avatars)]
+    messages = build_messages(dialogue)
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    params = output_schema.completion_params(params, [current_speaker])
+    events = streaming.stream_dialogue(
+        provider,
+        messages,
+        fallback=lambda raw_reply: format_error_reply(current_speaker),
+        speakers=[current_speaker],
+        on_complete=lambda reply: speculate_next_turn(dialogue, reply),
+        variant=VARIANT,
+        session_key=None,
+        prefetched=take_speculation(dialogue),
+        **params,
+    )
+    return await streaming.sse_response(events)
+
+
+# 批量接口：一次返回接下来 K 轮（Alice → Benji → Caden …），每轮只接受该轮发言者
+@app.post("/generate_batch")
+async def generate_batch(batch: BatchRequest):
+    structured_log.annotate(session_id=batch.session_id)
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    turns = autotalk_batch.batch_turns(
+        batch, batch.turns, build_messages, complete, format_error_reply, provider, params, VARIANT
+    )
+    if batch.stream:
+        return await streaming.sse_response(autotalk_batch.sse_turns(turns))
+    return {"turns": [{"turn_id": turn_id, "dialogue": [item]} async for turn_id, item in turns]}
@@ -2,21 +2,35 @@ import re
 
 from fastapi import FastAPI, Request
 from pydantic import BaseModel
-import os
-import json
 from typing import List
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from openai import OpenAI
+import backends
+import coalescing
+import deadline
+import metrics
+import structured_log
+from avatar_registry import registry
+import streaming
+import output_schema
+from prompt_cache import prompt_cache
+from history_manager import history_manager
+from lifespan import lifespan
+import service
 
-client = OpenAI(
-    api_key=os.getenv("CHATAI_API_KEY"),
-    base_url="https://chat-ai.academiccloud.de/v1"
-)
+app = FastAPI(lifespan=lifespan)
 
-app = FastAPI()
+VARIANT = "colive_qwen_chatai"
+PROVIDER = "chatai"
+COMPLETION_PARAMS = {
+    "model": "qwen3-32b",
+    "temperature": 0.7,
+    "max_tokens": 300,
+    "stop": ["\n\n", "```", "<|endoftext|>"],  # 这可帮助它在生成JSON结束后提前停止
+}
+service.install(app, VARIANT, PROVIDER, COMPLETION_PARAMS)
 
 
 class DialogueRequest(BaseModel):
@@ -26,44 +40,47 @@ class DialogueRequest(BaseModel):
     participant_role: str  # participant role, e.g.["Alice"]
 
 
-# 加载avatar.json中指定角色数据
-def load_avatar_data(names):
-    with open("avatars.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return {name: data[name] for name in names if name in data}
-
-
 # 讲角色卡格式化为gpt prompt格式
 def format_avatar_prompt(avatar):
     return (
-        f"Name: {avatar['name']}, Age: {avatar['age']}, "
-        f"Occupation: {avatar['occupation']}.\n"
-        f"Personality Traits: Openness {avatar['personality_traits']['Openness']}, "
-        f"Conscientiousness {avatar['personality_traits']['Conscientiousness']}, "
-        f"Extraversion {avatar['personality_traits']['Extraversion']}, "
-        f"Agreeableness {avatar['personality_traits']['Agreeableness']}, "
-        f"Neuroticism {avatar['personality_traits']['Neuroticism']}.\n"
-        f"Lifestyle Log: {avatar['lifestyle_log']}\n"
-        f"Hidden Motivation (private, only known to {avatar['name']}): {avatar['hidden_motivation']}\n"
-        f"Stance on House Rules: For {', '.join(avatar['stance_on_house_rules']['for'])}; "
-        f"Against {', '.join(avatar['stance_on_house_rules']['against'])}.\n"
+        f"Name: {avatar.name}, Age: {avatar.age}, Gender: {avatar.gender}"
+        f"{', Occupation: ' + avatar.occupation if avatar.occupation else ''}.\n"
+        f"Personality Traits: Openness {avatar.personality_traits.Openness}, "
+        f"Conscientiousness {avatar.personality_traits.Conscientiousness}, "
+        f"Extraversion {avatar.personality_traits.Extraversion}, "
+        f"Agreeableness {avatar.personality_traits.Agreeableness}, "
+        f"Neuroticism {avatar.personality_traits.Neuroticism}.\n"
+        f"Lifestyle Log: {avatar.lifestyle_log}\n"
+        f"Hidden Motivation (private, only known to {avatar.name}): {avatar.hidden_motivation}\n"
+        f"Stance on House Rules: For {', '.join(avatar.stance_on_house_rules.for_)}; "
+        f"Against {', '.join(avatar.stance_on_house_rules.against)}.\n"
     )
 
 
-# 主服务接口
-@app.post("/generate")
-async def generate_response(dialogue: DialogueRequest):
-    avatar_infos = load_avatar_data(dialogue.avatars)
-    gpt_avatars = [name for name in dialogue.avatars if name != dialogue.participant_role]
+# 模型输出不是合法 JSON 时的占位回复
+#   结构化输出下模型拒答时 content 为 None
+def format_error_reply(raw_reply):
+    return [{
+        "speaker": "System",
+        "text": "GPT response format error. Raw output:\n" + (raw_reply or ""),
+        "emotion": "neutral",
+        "gesture": "clapping"
+    }]
+
+
+# 构造 system prompt：只依赖角色列表与参与者角色，结果由 prompt_cache 复用
+def build_system_prompt(avatars, participant_role):
+    avatar_infos = registry.get_many(avatars)
+    gpt_avatars = [name for name in avatars if name != participant_role]
 
     persona_section = "\n---\n".join(
-        [format_avatar_prompt(avatar_infos[name]) for name in dialogue.avatars]
+        [format_avatar_prompt(avatar_infos[name]) for name in avatars]
     )
 
-    system_prompt = f"""
+    return f"""
     You are simulating a structured group discussion among three housemates in a shared intentional living experiment called **CoLive**.
 
-    The participant is currently role-playing as: **{dialogue.participant_role}**  
+    The participant is currently role-playing as: **{participant_role}**  
     You are controlling the other two avatars: **{gpt_avatars[0]}** and **{gpt_avatars[1]}**.
     
     Each avatar has a unique personality, lifestyle, and hidden motivation. They are now holding a **retrospective meeting** to decide:
@@ -208,40 +225,76 @@ async def generate_response(dialogue: DialogueRequest):
 
     ## Final Rules (DO NOT VIOLATE)
     
-    - Do NOT include any lines for {dialogue.participant_role} (the human participant)
+    - Do NOT include any lines for {participant_role} (the human participant)
     - Do NOT include narration, internal thoughts, or commentary
     - Do NOT generate explanations or context descriptions
     - Do NOT use markdown formatting (like ```json or triple backticks)
     - Only return the **raw JSON array** of 1–2 turns
     """
 
+
+# 构造发送给模型的消息列表
+@metrics.timed("prompt")
+def build_messages(dialogue):
+    system_prompt = prompt_cache.get(
+        (VARIANT, tuple(dialogue.avatars), dialogue.participant_role),
+        lambda: build_system_prompt(dialogue.avatars, dialogue.participant_role),
+    )
+
     # 构造历史信息
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    summary, recent_history = history_manager.window(dialogue.history, provider, params["model"])
     messages = [{"role": "system", "content": system_prompt}]
-    for msg in dialogue.history:
+    if summary:
+        messages.append({"role": "system", "content": summary})
+    for msg in recent_history:
         messages.append({"role": "user", "content": msg})
     messages.append({"role": "user", "content": dialogue.user_input})
 
+    return messages
+
+
+# 主服务接口
+@app.post("/generate")
+async def generate_response(dialogue: DialogueRequest):
+    gpt_avatars = [name for name in dialogue.avatars if name != dialogue.participant_role]
+    messages = build_messages(dialogue)
+
     # 调用gpt
-    response = client.chat.completions.create(
-        model="qwen3-32b",
-        messages=messages,
-        temperature=0.7,
-        max_tokens=300,
-        stop=["\n\n", "```", "<|endoftext|>"]  # 这可帮助它在生成JSON结束后提前停止
-    )
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    params = output_schema.completion_params(params, gpt_avatars)
+    try:
+        response = await coalescing.complete(provider, None, messages=messages, **params)
+    except deadline.DeadlineExceeded:
+        # 截止时间前拿不到回复：由角色说一句占位的话
+        return {"dialogue": deadline.stall_reply(gpt_avatars)}
 
     raw_reply = response.choices[0].message.content
-    print("=== GPT RAW ===\n", raw_reply)
+    structured_log.log_raw_reply(raw_reply)
 
-    # 尝试解析json输出
-    try:
-        reply_json = json.loads(raw_reply)
-    except json.JSONDecodeError:
-        reply_json = [{
-            "speaker": "System",
-            "text": "GPT response format error. Raw output:\n" + raw_reply,
-            "emotion": "neutral",
-            "gesture": "clapping"
-        }]
+    # 解析并校验json输出：只保留 AI avatar 的发言，emotion / gesture 不在列表中时修正
+    reply_json = output_schema.validate_reply(raw_reply, gpt_avatars, VARIANT, params["model"])
+    if not reply_json:
+        metrics.fallbacks_total.inc(VARIANT, params["model"])
+        reply_json = format_error_reply(raw_reply)
 
     return {"dialogue": reply_json}
+
+
+# 流式接口：每条发言一生成完就以 SSE 推送
+@app.post("/generate_stream")
+async def generate_stream(dialogue: DialogueRequest):
+    gpt_avatars = [name for name in dialogue.avatars if name != dialogue.participant_role]
+    messages = build_messages(dialogue)
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    params = output_schema.completion_params(params, gpt_avatars)
+    events = streaming.stream_dialogue(
+        provider,
+        messages,
+        fallback=format_error_reply,
+        speakers=gpt_avatars,
+        variant=VARIANT,
+        session_key=None,
+        **params,
+    )
+    return await streaming.sse_response(events)
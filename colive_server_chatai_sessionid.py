@@ -1,72 +1,119 @@
 from fastapi import FastAPI, Request
 from pydantic import BaseModel
 import os
-import json
-from typing import List
+from collections import OrderedDict
+from typing import List, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from openai import OpenAI
-
-client = OpenAI(
-    api_key=os.getenv("CHATAI_API_KEY"),
-    base_url="https://chat-ai.academiccloud.de/v1"
-)
-
-app = FastAPI()
+import backends
+import coalescing
+import deadline
+import metrics
+import structured_log
+from avatar_registry import registry
+import streaming
+import output_schema
+from prompt_cache import prompt_cache
+from history_manager import history_manager
+from session_store import session_store
+from session_log import session_log, turn_lines
+from lifespan import lifespan
+import service
+
+app = FastAPI(lifespan=lifespan)
+
+VARIANT = "colive_server_chatai_sessionid"
+PROVIDER = "chatai"
+COMPLETION_PARAMS = {
+    "model": "meta-llama-3.1-8b-instruct",
+    "temperature": 0.7,
+    "max_tokens": 250,
+}
+service.install(app, VARIANT, PROVIDER, COMPLETION_PARAMS)
 
 
 class DialogueRequest(BaseModel):
     session_id: str  # 新增字段
     user_input: str
-    history: List[str]
+    history: Optional[List[str]] = None  # 省略时使用服务器端保存的会话历史
     avatars: List[str]  # role name, e.g.["Alice", "Benji", "Caden"]
     participant_role: str  # participant role, e.g.["Alice"]
 
 
-# 加载avatar.json中指定角色数据
-def load_avatar_data(names):
-    with open("avatars.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return {name: data[name] for name in names if name in data}
-
-
 # 讲角色卡格式化为gpt prompt格式
 def format_avatar_prompt(avatar):
     return (
-        f"Name: {avatar['name']}, Age: {avatar['age']}, Gender: {avatar['gender']}.\n"
+        f"Name: {avatar.name}, Age: {avatar.age}, Gender: {avatar.gender}.\n"
         f"Personality Traits (NEO-FFI-30 scale, 0–24):\n"
-        f"  - Openness: {avatar['personality_traits']['Openness']}\n"
-        f"  - Conscientiousness: {avatar['personality_traits']['Conscientiousness']}\n"
-        f"  - Extraversion: {avatar['personality_traits']['Extraversion']}\n"
-        f"  - Agreeableness: {avatar['personality_traits']['Agreeableness']}\n"
-        f"  - Neuroticism: {avatar['personality_traits']['Neuroticism']}\n"
-        f"{avatar['personality_description']}\n\n"
-        f"Lifestyle Log:\n{avatar['lifestyle_log']}\n\n"
-        f"Hidden Motivation (private, only known to {avatar['name']}):\n{avatar['hidden_motivation']}\n\n"
+        f"  - Openness: {avatar.personality_traits.Openness}\n"
+        f"  - Conscientiousness: {avatar.personality_traits.Conscientiousness}\n"
+        f"  - Extraversion: {avatar.personality_traits.Extraversion}\n"
+        f"  - Agreeableness: {avatar.personality_traits.Agreeableness}\n"
+        f"  - Neuroticism: {avatar.personality_traits.Neuroticism}\n"
+        f"{avatar.personality_description}\n\n"
+        f"Lifestyle Log:\n{avatar.lifestyle_log}\n\n"
+        f"Hidden Motivation (private, only known to {avatar.name}):\n{avatar.hidden_motivation}\n\n"
         f"Stance on House Rules:\n"
-        f"  - Supports: {', '.join(avatar['stance_on_house_rules']['for'])}\n"
-        f"  - Opposes: {', '.join(avatar['stance_on_house_rules']['against'])}\n"
+        f"  - Supports: {', '.join(avatar.stance_on_house_rules.for_)}\n"
+        f"  - Opposes: {', '.join(avatar.stance_on_house_rules.against)}\n"
     )
 
 
-# 主服务接口
-@app.post("/generate")
-async def generate_response(dialogue: DialogueRequest):
-    avatar_infos = load_avatar_data(dialogue.avatars)
-    gpt_avatars = [name for name in dialogue.avatars if name != dialogue.participant_role]
+# 日志记录：只记录本轮增量，由后台任务批量追加到 logs/{session_id}.jsonl
+@metrics.timed("log_write")
+def write_session_log(dialogue, response):
+    session_log.write(
+        dialogue.session_id, dialogue.participant_role, dialogue.user_input, len(dialogue.history or []), response
+    )
+
+
+# 客户端省略 history 时从会话存储读取；仍上传完整 history 的旧客户端以其为准
+async def resolve_history(dialogue):
+    if dialogue.history is None:
+        dialogue.history = await session_store.get_history(dialogue.session_id)
+    else:
+        await session_store.replace(dialogue.session_id, dialogue.history)
+
+
+# 每个会话最近记录的一轮的请求指纹（与单飞合并用同一个 key）
+_recorded_turns = OrderedDict()
+
+
+# 一轮结束：写日志，并把参与者输入与 avatar 回复追加到会话历史
+#   被合并的重复请求（双击、重试）指纹相同，只记录一次；真正重复的一轮历史已经变长，指纹不同
+async def finish_turn(dialogue, reply, turn_key):
+    if _recorded_turns.get(dialogue.session_id) == turn_key:
+        return
+    _recorded_turns[dialogue.session_id] = turn_key
+    _recorded_turns.move_to_end(dialogue.session_id)
+    while len(_recorded_turns) > session_store.max_sessions:
+        _recorded_turns.popitem(last=False)
+    lines = turn_lines(dialogue.participant_role, dialogue.user_input, reply)
+    write_session_log(dialogue, reply)
+    await session_store.append(dialogue.session_id, lines)
+
+
+# 没有可用发言时由第一个 AI avatar 给出占位回复（避免 Unity 报错）
+def fallback_reply(speaker, text):
+    return [{
+        "speaker": speaker,
+        "text": text,
+        "emotion": "neutral",
+        "gesture": "start talking"
+    }]
+
+
+# 构造 system prompt 的静态前缀：只依赖角色列表，所有会话字节级一致，便于上游 prefix cache 命中
+def build_system_prompt(avatars):
+    avatar_infos = registry.get_many(avatars)
 
     persona_section = "\n---\n".join(
-        [format_avatar_prompt(avatar_infos[name]) for name in dialogue.avatars]
+        [format_avatar_prompt(avatar_infos[name]) for name in avatars]
     )
 
-    system_prompt = f"""
-    ---
-    Session Info:
-    This is a distinct and isolated conversation with session ID: {dialogue.session_id}.
-    Do not refer to or depend on any content outside of this session.
-    ---
+    return f"""
     
     You are simulating a group discussion among three housemates living together in a shared intentional living community called CoLive.
 
@@ -76,12 +123,6 @@ async def generate_response(dialogue: DialogueRequest):
     - Should they continue living together?
     - If yes, what changes are needed to the house rules?
     
-    ---
-    Roles:
-    The human participant is currently role-playing as {dialogue.participant_role}.
-    The other two avatars — {gpt_avatars[0]} and {gpt_avatars[1]} — are simulated by you, the AI.
-    Each avatar has a unique personality, lifestyle log, speaking style, and hidden motivations.
-
     ---
     House Rules (Discussion Topics)
     Avatars will discuss the following topics **in order**, starting from Topic 1. Do not skip or merge topics. Ensure a **natural transition** between them.
@@ -119,40 +160,6 @@ async def generate_response(dialogue: DialogueRequest):
 
     Make the transition feel natural and character-appropriate. Do not skip topics or jump ahead unless explicitly indicated in the dialogue history.
     ---
-    
-    ---
-    Rules for Speaking:
-    
-    - Only simulate the two AI-controlled avatars: {gpt_avatars[0]} and {gpt_avatars[1]}.
-    - NEVER simulate or speak for the human participant: {dialogue.participant_role}.
-    - NEVER include {dialogue.participant_role} in the output speaker field.
-    - NEVER paraphrase, interpret, or comment on {dialogue.participant_role}’s message.
-    - NEVER attempt to fix, assume, or continue a message from {dialogue.participant_role}, even if it appears incomplete.
-    - ALWAYS treat {dialogue.participant_role} as an external input. You must not respond on their behalf.
-    
-    If the most recent message in the history is from {dialogue.participant_role}, your response must begin with either {gpt_avatars[0]} or {gpt_avatars[1]}.
-    
-    Output policy:
-    - Only output 1–2 utterances in **structured JSON format**.
-    - Each item must contain: speaker, text, emotion, gesture.
-    - Speaker must be {gpt_avatars[0]} or {gpt_avatars[1]} only.
-    - NO markdown. NO extra explanations. Return the JSON array only.
-    
-    
-    Violating these rules (e.g., generating for {dialogue.participant_role}, adding commentary, or misformatting) will lead to **response rejection**.
-    
-    ---
-    DO NOT FIX OR RESPOND TO PARTICIPANT INPUT
-    
-    - If the human participant ({dialogue.participant_role}) says something unclear, incomplete, or vague:
-      → Do NOT guess or fill in what they meant.
-      → Do NOT reply with corrections like “Did you mean...?”
-      → Do NOT continue their sentence or offer clarification.
-    
-    - Treat any participant input as already complete and valid.
-    - Simply continue the conversation from the AI avatars' perspective.
-
-        
     ---
     
     For each turn, output a structured object with the following fields:
@@ -306,68 +313,155 @@ async def generate_response(dialogue: DialogueRequest):
     
     """
 
+
+# 构造 system prompt 的尾部：参与者角色与 session_id 等每个会话不同的内容
+def build_session_tail(avatars, participant_role, session_id):
+    gpt_avatars = [name for name in avatars if name != participant_role]
+
+    return f"""
+    ---
+    Roles:
+    The human participant is currently role-playing as {participant_role}.
+    The other two avatars — {gpt_avatars[0]} and {gpt_avatars[1]} — are simulated by you, the AI.
+    Each avatar has a unique personality, lifestyle log, speaking style, and hidden motivations.
+
+    
+    ---
+    Rules for Speaking:
+    
+    - Only simulate the two AI-controlled avatars: {gpt_avatars[0]} and {gpt_avatars[1]}.
+    - NEVER simulate or speak for the human participant: {participant_role}.
+    - NEVER include {participant_role} in the output speaker field.
+    - NEVER paraphrase, interpret, or comment on {participant_role}’s message.
+    - NEVER attempt to fix, assume, or continue a message from {participant_role}, even if it appears incomplete.
+    - ALWAYS treat {participant_role} as an external input. You must not respond on their behalf.
+    
+    If the most recent message in the history is from {participant_role}, your response must begin with either {gpt_avatars[0]} or {gpt_avatars[1]}.
+    
+    Output policy:
+    - Only output 1–2 utterances in **structured JSON format**.
+    - Each item must contain: speaker, text, emotion, gesture.
+    - Speaker must be {gpt_avatars[0]} or {gpt_avatars[1]} only.
+    - NO markdown. NO extra explanations. Return the JSON array only.
+    
+    
+    Violating these rules (e.g., generating for {participant_role}, adding commentary, or misformatting) will lead to **response rejection**.
+    
+    ---
+    DO NOT FIX OR RESPOND TO PARTICIPANT INPUT
+    
+    - If the human participant ({participant_role}) says something unclear, incomplete, or vague:
+      → Do NOT guess or fill in what they meant.
+      → Do NOT reply with corrections like “Did you mean...?”
+      → Do NOT continue their sentence or offer clarification.
+    
+    - Treat any participant input as already complete and valid.
+    - Simply continue the conversation from the AI avatars' perspective.
+
+        
+    ---
+    Session Info:
+    This is a distinct and isolated conversation with session ID: {session_id}.
+    Do not refer to or depend on any content outside of this session.
+    ---
+    """
+
+
+# 发言人提醒：trailing 只在最新输入之后追加一条；per_message 为旧行为，每条历史之后都追加
+REMINDER_MODE = os.getenv("REMINDER_MODE", "trailing")
+
+
+# 构造发送给模型的消息列表
+@metrics.timed("prompt")
+def build_messages(dialogue, reminder_mode=REMINDER_MODE):
+    static_prompt = prompt_cache.get(
+        (VARIANT, tuple(dialogue.avatars)),
+        lambda: build_system_prompt(dialogue.avatars),
+    )
+    # 每个会话不同的尾部只用一次，不放进共享的 prompt 缓存
+    system_prompt = static_prompt + build_session_tail(dialogue.avatars, dialogue.participant_role, dialogue.session_id)
+    gpt_avatars = [name for name in dialogue.avatars if name != dialogue.participant_role]
+    reminder = {
+        "role": "system",
+        "content": f"The previous message was from the participant {dialogue.participant_role}. Now only generate a response from {gpt_avatars[0]} and {gpt_avatars[1]}. Do NOT speak for {dialogue.participant_role}."
+    }
+
     # 构造历史信息
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    summary, recent_history = history_manager.window(dialogue.history, provider, params["model"])
     messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        messages.append({"role": "system", "content": summary})
 
-    for msg in dialogue.history:
+    for msg in recent_history:
         messages.append({"role": "user", "content": msg})
-        messages.append({
-            "role": "system",
-            "content": f"The previous message was from the participant {dialogue.participant_role}. Now only generate a response from {gpt_avatars[0]} and {gpt_avatars[1]}. Do NOT speak for {dialogue.participant_role}."
-        })
+        if reminder_mode == "per_message":
+            messages.append(reminder)
 
-    # 添加当前用户输入
+    # 添加当前用户输入；服务器端的 speaker 过滤仍然兜底
     messages.append({"role": "user", "content": dialogue.user_input})
-    messages.append({
-        "role": "system",
-        "content": f"The previous message was from the participant {dialogue.participant_role}. Now only generate a response from {gpt_avatars[0]} and {gpt_avatars[1]}. Do NOT speak for {dialogue.participant_role}."
-    })
+    messages.append(reminder)
 
-    # 调用gpt
-    response = client.chat.completions.create(
-        model="meta-llama-3.1-8b-instruct",
-        messages=messages,
-        temperature=0.7,
-        max_tokens=250,
-    )
+    return messages
 
-    raw_reply = response.choices[0].message.content
-    print("=== GPT RAW ===\n", raw_reply)
 
-    # 尝试解析json输出
+# 主服务接口
+@app.post("/generate")
+async def generate_response(dialogue: DialogueRequest):
+    structured_log.annotate(session_id=dialogue.session_id)
+    gpt_avatars = [name for name in dialogue.avatars if name != dialogue.participant_role]
+    await resolve_history(dialogue)
+    messages = build_messages(dialogue)
+
+    # 调用gpt
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    params = output_schema.completion_params(params, gpt_avatars)
+    turn_key = coalescing.request_key(provider, {"messages": messages, **params})
     try:
-        reply_json = json.loads(raw_reply)
-        # 只保留 GPT avatar 的发言，过滤掉不合法的 speaker（如 participant）
-        valid_speakers = set(gpt_avatars)
-        filtered_reply = [turn for turn in reply_json if turn.get("speaker") in valid_speakers]
+        response = await coalescing.complete(provider, dialogue.session_id, messages=messages, **params)
+    except deadline.DeadlineExceeded:
+        # 截止时间前拿不到回复：由角色说一句占位的话
+        filtered_reply = deadline.stall_reply(gpt_avatars)
+        await finish_turn(dialogue, filtered_reply, turn_key)
+        return {"dialogue": filtered_reply}
 
+    raw_reply = response.choices[0].message.content
+    structured_log.log_raw_reply(raw_reply)
+
+    # 解析并校验json输出：只保留 GPT avatar 的发言，过滤掉不合法的 speaker（如 participant），emotion / gesture 不合法时修正
+    filtered_reply = output_schema.validate_reply(raw_reply, gpt_avatars, VARIANT, params["model"])
+    if filtered_reply is None:
+        metrics.fallbacks_total.inc(VARIANT, params["model"])
+        filtered_reply = fallback_reply(gpt_avatars[0], "Looks like I got confused. Let’s try again!")
+    elif not filtered_reply:
         # 如果被过滤为空，就用提示替代（避免 Unity 报错）
-        if not filtered_reply:
-            filtered_reply = [{
-                "speaker": gpt_avatars[0],
-                "text": "Sorry, I didn’t quite get that—could you say it again?",
-                "emotion": "neutral",
-                "gesture": "start talking"
-            }]
-    except json.JSONDecodeError:
-        filtered_reply = [{
-            "speaker": gpt_avatars[0],
-            "text": "Looks like I got confused. Let’s try again!",
-            "emotion": "neutral",
-            "gesture": "start talking"
-        }]
-
-    # 日志记录每次请求
-    os.makedirs("logs", exist_ok=True)
-    with open(f"logs/{dialogue.session_id}.jsonl", "a", encoding="utf-8") as f:
-        json.dump({
-            "session_id": dialogue.session_id,
-            "user_input": dialogue.user_input,
-            "history": dialogue.history,
-            "response": filtered_reply
-        }, f)
-        f.write("\n")
+        metrics.fallbacks_total.inc(VARIANT, params["model"])
+        filtered_reply = fallback_reply(gpt_avatars[0], "Sorry, I didn’t quite get that—could you say it again?")
+
+    # 日志记录每次请求，并更新会话历史
+    await finish_turn(dialogue, filtered_reply, turn_key)
 
     return {"dialogue": filtered_reply}
 
 
+# 流式接口：每条发言一生成完就以 SSE 推送，同样只保留 AI avatar 的发言
+@app.post("/generate_stream")
+async def generate_stream(dialogue: DialogueRequest):
+    structured_log.annotate(session_id=dialogue.session_id)
+    gpt_avatars = [name for name in dialogue.avatars if name != dialogue.participant_role]
+    await resolve_history(dialogue)
+    messages = build_messages(dialogue)
+    provider, params = backends.resolve(PROVIDER, COMPLETION_PARAMS)
+    params = output_schema.completion_params(params, gpt_avatars)
+    turn_key = coalescing.request_key(provider, {"messages": messages, **params})
+    events = streaming.stream_dialogue(
+        provider,
+        messages,
+        fallback=lambda raw_reply: fallback_reply(gpt_avatars[0], "Looks like I got confused. Let’s try again!"),
+        speakers=gpt_avatars,
+        on_complete=lambda reply: finish_turn(dialogue, reply, turn_key),
+        variant=VARIANT,
+        session_key=dialogue.session_id,
+        **params,
+    )
+    return await streaming.sse_response(events)
@@ -0,0 +1,93 @@
+"""
+单进程提供全部七个版本：共用角色卡注册表、prompt 缓存、上游连接池与统计。
+
+选择 variant:
+  - 路由: POST /{variant}/generate、/{variant}/generate_stream、/{variant}/generate_batch
+    （variant 为模块名，如 colive_server_llama；generate_batch 只有 autotalk 版本提供）
+  - 请求头: POST /generate 等配合 X-Colive-Variant: colive_server_llama（缺省为 COLIVE_DEFAULT_VARIANT）
+选择模型: 请求头 X-Colive-Model: qwen3-32b（必须在 backends.MODELS 中），否则使用 variant 的默认模型
+
+用法:
+    uvicorn colive_unified:app --port 8000
+"""
+import importlib
+import os
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+import backends
+import service
+from lifespan import lifespan
+
+VARIANTS = [
+    "main",
+    "colive_server_chatai",
+    "colive_server_chatai_sessionid",
+    "colive_server_llama",
+    "colive_qwen_chatai",
+    "colive_autotalk_server",
+    "colive_autotalk_server_chatai",
+]
+DEFAULT_VARIANT = os.getenv("COLIVE_DEFAULT_VARIANT", "main")
+
+VARIANT_HEADER = b"x-colive-variant"
+MODEL_HEADER = b"x-colive-model"
+HEADER_ROUTES = ("/generate", "/generate_stream", "/generate_batch")
+
+# 各版本的 app 只作为子应用挂载，生命周期钩子由本 app 统一执行一次
+modules = {name: importlib.import_module(name) for name in VARIANTS}
+
+app = FastAPI(lifespan=lifespan)
+for _name, _module in modules.items():
+    app.mount(f"/{_name}", _module.app)
+
+
+@app.get("/variants")
+async def variants():
+    return {
+        "default": DEFAULT_VARIANT,
+        "variants": {name: module.COMPLETION_PARAMS["model"] for name, module in modules.items()},
+        "models": backends.MODELS,
+    }
+
+
+# 全部 variant 共用一个进程内指标注册表
+service.add_stats_routes(app)
+
+
+# ASGI 中间件：按请求头把 /generate 转到对应 variant，并为本次请求设置模型
+class VariantSelector:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        if scope["path"] in HEADER_ROUTES:
+            variant = headers.get(VARIANT_HEADER, b"").decode() or DEFAULT_VARIANT
+            if variant not in modules:
+                await JSONResponse({"detail": f"unknown variant: {variant}"}, status_code=404)(scope, receive, send)
+                return
+            path = f"/{variant}{scope['path']}"
+            scope = {**scope, "path": path, "raw_path": path.encode()}
+
+        model = headers.get(MODEL_HEADER, b"").decode()
+        if not model:
+            await self.app(scope, receive, send)
+            return
+        try:
+            token = backends.set_model_override(model)
+        except KeyError:
+            await JSONResponse({"detail": f"unknown model: {model}"}, status_code=400)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            backends.reset_model_override(token)
+
+
+app.add_middleware(VariantSelector)
@@ -0,0 +1,124 @@
+"""
+对比 chatai/sessionid 服务器两种发言人提醒模式（REMINDER_MODE）。
+
+- per_message: 旧行为，每条历史消息后都追加一条 system 提醒
+- trailing:    只在最新输入之后追加一条提醒，依靠服务器端 speaker 过滤兜底
+
+默认只根据 logs/*.jsonl（经 rebuild_transcripts 还原完整 history）重建每一轮的请求，比较消息条数与 prompt token 数；
+加 --replay N 时会把其中 N 轮分别用两种模式重新请求上游，比较解析失败率、
+参与者被代言的比例和被 speaker 过滤丢弃的发言比例。
+
+用法:
+    python compare_reminder_modes.py --logs logs
+    python compare_reminder_modes.py --logs logs --replay 50
+"""
+import argparse
+import asyncio
+
+import llm_client
+import output_schema
+from colive_server_chatai_sessionid import COMPLETION_PARAMS, PROVIDER, DialogueRequest, build_messages
+from history_manager import count_tokens
+from rebuild_transcripts import load_sessions
+
+MODES = ("per_message", "trailing")
+MESSAGE_OVERHEAD_TOKENS = 4  # chat 格式中每条消息的固定开销（估算）
+
+
+# 会话日志不记录角色列表，由 --avatars 指定
+def load_turns(log_dir, avatars, participant_role):
+    turns = []
+    for records, _ in load_sessions(log_dir, participant_role).values():
+        for record in records:
+            turns.append(DialogueRequest(
+                session_id=record["session_id"],
+                user_input=record["user_input"],
+                history=record["history"],
+                avatars=avatars,
+                participant_role=record.get("participant_role", participant_role),
+            ))
+    return turns
+
+
+def prompt_tokens(messages):
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def compare_tokens(turns):
+    print(f"{'mode':<12} {'turns':>6} {'messages':>10} {'tokens':>12} {'tokens/turn':>12}")
+    totals = {}
+    for mode in MODES:
+        message_count = 0
+        tokens = 0
+        for dialogue in turns:
+            messages = build_messages(dialogue, reminder_mode=mode)
+            message_count += len(messages)
+            tokens += prompt_tokens(messages)
+        totals[mode] = tokens
+        print(f"{mode:<12} {len(turns):>6} {message_count:>10} {tokens:>12} {tokens / max(len(turns), 1):>12.1f}")
+    saved = totals["per_message"] - totals["trailing"]
+    print(f"trailing saves {saved} prompt tokens ({saved / max(totals['per_message'], 1):.1%})")
+
+
+async def replay_turn(dialogue, mode):
+    messages = build_messages(dialogue, reminder_mode=mode)
+    response = await llm_client.chat_completion(PROVIDER, messages=messages, **COMPLETION_PARAMS)
+    # 与服务器相同的解析：兼容 ```json 包裹、前言、尾逗号与截断
+    reply = output_schema.parse_reply(response.choices[0].message.content)
+    if reply is None:
+        return {"parse_failure": 1}
+
+    gpt_avatars = {name for name in dialogue.avatars if name != dialogue.participant_role}
+    utterances = [turn for turn in reply if isinstance(turn, dict)]
+    kept = [turn for turn in utterances if turn.get("speaker") in gpt_avatars]
+    return {
+        "utterances": len(utterances),
+        "participant_spoken": sum(1 for turn in utterances if turn.get("speaker") == dialogue.participant_role),
+        "dropped": len(utterances) - len(kept),
+        "empty_after_filter": int(not kept),
+    }
+
+
+async def replay(turns, sample, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(dialogue, mode):
+        async with semaphore:
+            return await replay_turn(dialogue, mode)
+
+    print(f"\nreplaying {len(turns[:sample])} logged turns per mode")
+    print(f"{'mode':<12} {'parse fail':>11} {'participant':>12} {'dropped':>9} {'empty':>7}")
+    for mode in MODES:
+        results = await asyncio.gather(*(run(dialogue, mode) for dialogue in turns[:sample]))
+        n = len(results)
+        utterances = sum(r.get("utterances", 0) for r in results)
+        print(
+            f"{mode:<12}"
+            f" {sum(r.get('parse_failure', 0) for r in results) / n:>11.1%}"
+            f" {sum(r.get('participant_spoken', 0) for r in results) / max(utterances, 1):>12.1%}"
+            f" {sum(r.get('dropped', 0) for r in results) / max(utterances, 1):>9.1%}"
+            f" {sum(r.get('empty_after_filter', 0) for r in results) / n:>7.1%}"
+        )
+    await llm_client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logs", default="logs")
+    parser.add_argument("--avatars", nargs="+", default=["Alice", "Benji", "Caden"], help="会话的角色列表（日志中没有记录）")
+    parser.add_argument("--participant", default="Alice", help="日志中没有记录 participant_role 时使用")
+    parser.add_argument("--replay", type=int, default=0, help="重新请求上游的轮数（需要 API key）")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    turns = load_turns(args.logs, args.avatars, args.participant)
+    if not turns:
+        print(f"no logged turns found in {args.logs}/")
+        return
+    compare_tokens(turns)
+    if args.replay:
+        asyncio.run(replay(turns, args.replay, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import asyncio
+import contextvars
+import os
+import random
+import time
+
+import backends
+import metrics
+import output_schema
+from gesture_rules import gesture_rules
+
+# 客户端剩余的时间预算（毫秒），例如 X-Colive-Deadline-Ms: 1500；用相对值，不受两端时钟偏差影响
+DEADLINE_HEADER = b"x-colive-deadline-ms"
+# 为解析、发送回复预留的时间（秒）
+DEADLINE_MARGIN = float(os.getenv("DEADLINE_MARGIN", "0.15"))
+# 一条完整发言（含 JSON 结构）至少需要的 token 数；预算连这也不够时直接用占位发言
+MIN_COMPLETION_TOKENS = int(os.getenv("DEADLINE_MIN_TOKENS", "40"))
+# 没有样本时的先验：首 token 延迟（秒）与生成速度（token/秒）
+DEFAULT_TTFT = float(os.getenv("DEADLINE_DEFAULT_TTFT", "0.8"))
+DEFAULT_TPS = float(os.getenv("DEADLINE_DEFAULT_TPS", "40"))
+EWMA_ALPHA = 0.2
+# 少于这么多 token 的补全不用于估计生成速度（主要是首 token 延迟）
+MIN_SAMPLE_TOKENS = 10
+# 估计预算不够时仍按这个比例放行请求作为探测，避免过于悲观的估计永远得不到新样本
+DEADLINE_PROBE_RATE = float(os.getenv("DEADLINE_PROBE_RATE", "0.05"))
+
+# 截止时间前拿不到回复时，由角色说一句占位的话，而不是让 Unity 等到超时
+STALL_LINES = (
+    "Hmm, give me a second to think about that.",
+    "Let me think about that for a moment.",
+    "Good question. Let me gather my thoughts.",
+)
+
+plans_total = metrics.Counter("colive_deadline_plans_total", "Completions adjusted to fit the client deadline", ("variant", "model", "action"))
+exceeded_total = metrics.Counter(
+    "colive_deadline_exceeded_total", "Replies replaced by an in-character stall line because of the client deadline", ("variant", "model", "stage")
+)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# 本次请求必须回复的时刻（time.monotonic），由 AdmissionMiddleware 按请求头设置
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def start(headers):
+    value = dict(headers).get(DEADLINE_HEADER)
+    if value is None:
+        return None
+    try:
+        budget = float(value) / 1000
+    except ValueError:
+        return None
+    return _deadline.set(time.monotonic() + budget)
+
+
+def reset(token):
+    if token is not None:
+        _deadline.reset(token)
+
+
+# 不带截止时间的上下文，用于请求结束后仍在运行的后台任务（如预测性生成）
+def detached_context():
+    context = contextvars.copy_context()
+    context.run(_deadline.set, None)
+    return context
+
+
+# 扣除预留时间后的剩余预算（秒）；没有截止时间时为 None
+def remaining():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - DEADLINE_MARGIN - time.monotonic()
+
+
+# 每个模型的首 token 延迟与生成速度（EWMA），由实际补全在线学习
+class ModelSpeed:
+    def __init__(self):
+        self.ttft = DEFAULT_TTFT
+        self.tps = DEFAULT_TPS
+        self.stream_samples = 0
+        self.samples = 0
+
+
+def _ewma(current, sample, count):
+    return sample if count == 0 else current + EWMA_ALPHA * (sample - current)
+
+
+class ThroughputEstimator:
+    def __init__(self):
+        self._models = {}
+
+    def _speed(self, model):
+        speed = self._models.get(model)
+        if speed is None:
+            speed = self._models[model] = ModelSpeed()
+        return speed
+
+    # seconds: 从发出请求到补全结束；ttft 只有流式请求才有
+    #   流式补全可以直接测出首 token 延迟和生成速度，以它为准；
+    #   还没有流式样本时，用非流式补全扣除先验的首 token 延迟估计生成速度
+    def record(self, model, seconds, tokens, ttft=None):
+        speed = self._speed(model)
+        if ttft is not None:
+            decode = seconds - ttft
+            if tokens >= MIN_SAMPLE_TOKENS and decode > 0:
+                speed.tps = _ewma(speed.tps, tokens / decode, speed.stream_samples)
+            speed.ttft = _ewma(speed.ttft, ttft, speed.stream_samples)
+            speed.stream_samples += 1
+        elif speed.stream_samples == 0:
+            decode = seconds - speed.ttft
+            if tokens >= MIN_SAMPLE_TOKENS and decode > 0:
+                speed.tps = _ewma(speed.tps, tokens / decode, speed.samples)
+        speed.samples += 1
+
+    # 是否已有该模型的实际样本
+    def learned(self, model):
+        return self._speed(model).samples > 0
+
+    # budget 秒内预计能生成的补全 token 数
+    def affordable(self, model, budget):
+        speed = self._speed(model)
+        return max(0, int((budget - speed.ttft) * speed.tps))
+
+    def stats(self):
+        return {
+            model: {"ttft": speed.ttft, "tokens_per_sec": speed.tps, "samples": speed.samples, "stream_samples": speed.stream_samples}
+            for model, speed in self._models.items()
+        }
+
+
+throughput = ThroughputEstimator()
+
+
+# 按剩余预算调整本次补全：够用时不变；只够较短的回复时下调 max_tokens（截断的最后一条发言由 json_extract 挽救）；
+#   连最短回复都不够时改用预计最快的备用模型，仍不够则抛 DeadlineExceeded，由调用方返回占位发言
+#   模型还没有样本时不做调整（先验只是猜测），否则按先验拒绝的请求永远不会发出，估计也就无从学习
+#   alternates: 可以替换的备用模型（由路由层按健康状况给出）
+def plan(provider, params, alternates=()):
+    budget = remaining()
+    if budget is None:
+        return provider, params
+    model = params["model"]
+    if not throughput.learned(model):
+        plans_total.inc(metrics.current_labels()[0], model, "unlearned")
+        return provider, params
+    wanted = params.get("max_tokens")
+    affordable = throughput.affordable(model, budget)
+    if wanted is not None and affordable >= wanted:
+        return provider, params
+    variant = metrics.current_labels()[0]
+    if affordable >= MIN_COMPLETION_TOKENS:
+        plans_total.inc(variant, model, "trimmed")
+        return provider, {**params, "max_tokens": affordable}
+
+    candidates = [(throughput.affordable(alternate, budget), alternate) for alternate in alternates]
+    if candidates:
+        affordable, alternate = max(candidates)
+        if affordable >= MIN_COMPLETION_TOKENS:
+            plans_total.inc(variant, model, "switched")
+            return backends.MODELS[alternate], {**output_schema.switch_model(params, alternate), "max_tokens": min(wanted or affordable, affordable)}
+    if random.random() < DEADLINE_PROBE_RATE:
+        plans_total.inc(variant, model, "probe")
+        return provider, params
+    exceeded_total.inc(variant, model, "planned")
+    raise DeadlineExceeded(f"{budget:.3f}s left, not enough for {MIN_COMPLETION_TOKENS} tokens")
+
+
+# 在截止时间之前等待 awaitable，到时抛 DeadlineExceeded（awaitable 随之被取消）；没有截止时间时直接等待
+async def within(awaitable):
+    budget = remaining()
+    if budget is None:
+        return await awaitable
+    try:
+        async with asyncio.timeout(budget) as scope:
+            return await awaitable
+    except TimeoutError:
+        if not scope.expired():
+            raise
+        exceeded_total.inc(*metrics.current_labels(), "upstream")
+        raise DeadlineExceeded("deadline reached while waiting for upstream") from None
+
+
+# 占位发言：由第一个可发言的 avatar 以 thinking 情绪说一句，手势按该 avatar 的搭配指南选择
+def stall_reply(speakers):
+    speaker = speakers[0]
+    return [{
+        "speaker": speaker,
+        "text": random.choice(STALL_LINES),
+        "emotion": "thinking",
+        "gesture": gesture_rules.gesture_for(speaker, "thinking"),
+    }]
+
+
+def stats():
+    return throughput.stats()
@@ -0,0 +1,74 @@
+import json
+import os
+from types import MappingProxyType
+from typing import FrozenSet, Mapping, NamedTuple, Tuple
+
+
+# 单个 avatar 编译后的查表（全部只读）
+class AvatarGestures(NamedTuple):
+    gestures: Tuple[str, ...]  # 按 prompt 中的顺序，第一个为默认手势
+    allowed: FrozenSet[str]
+    pairs: FrozenSet[Tuple[str, str]]  # 指南中的 (gesture, emotion) 搭配
+    gesture_for: Mapping[str, str]  # emotion -> 最接近的合法手势
+    emotion_for: Mapping[str, str]  # gesture -> 与之搭配的第一个合法 emotion
+
+
+# avatar_gestures.json（与 prompt 中的 Gesture–Emotion Pairing Guide 一致）启动时编译成只读查表，
+#   每条发言的校验和修复都是几次集合 / 字典查找
+class GestureRules:
+    def __init__(self, data):
+        self.emotions = tuple(data["emotions"])
+        self.emotion_set = frozenset(self.emotions)
+        self.default_emotion = data["default_emotion"]
+        self.avatars = MappingProxyType({
+            avatar: self._compile(guide) for avatar, guide in data["avatars"].items()
+        })
+        # 表中没有的 avatar 只允许默认手势
+        self.fallback = self._compile({data["default_gesture"]: list(self.emotions)})
+
+    def _compile(self, guide):
+        order = tuple(guide)
+        return AvatarGestures(
+            gestures=order,
+            allowed=frozenset(order),
+            pairs=frozenset((gesture, emotion) for gesture, emotions in guide.items() for emotion in emotions),
+            # 指南中第一个与该 emotion 搭配的手势，没有则用第一个手势
+            gesture_for=MappingProxyType({
+                emotion: next((gesture for gesture in order if emotion in guide[gesture]), order[0])
+                for emotion in self.emotions
+            }),
+            emotion_for=MappingProxyType({
+                gesture: next((emotion for emotion in guide[gesture] if emotion in self.emotion_set), self.default_emotion)
+                for gesture in order
+            }),
+        )
+
+    def gestures(self, speaker):
+        return self.avatars.get(speaker, self.fallback).gestures
+
+    # 与 emotion 最接近的合法手势（emotion 须在 emotions 列表中）
+    def gesture_for(self, speaker, emotion):
+        return self.avatars.get(speaker, self.fallback).gesture_for[emotion]
+
+    # 修复 emotion / gesture：emotion 不合法时取手势搭配的 emotion，手势不属于该 avatar 时取最接近该 emotion 的手势
+    #   problems: 计数字典（如 defaultdict(int)），记录 invalid_emotion / invalid_gesture / unpaired
+    def repair(self, speaker, emotion, gesture, problems):
+        rules = self.avatars.get(speaker, self.fallback)
+        if emotion not in self.emotion_set:
+            problems["invalid_emotion"] += 1
+            emotion = rules.emotion_for.get(gesture, self.default_emotion)
+        if gesture not in rules.allowed:
+            problems["invalid_gesture"] += 1
+            gesture = rules.gesture_for[emotion]
+        elif (gesture, emotion) not in rules.pairs:
+            # 指南只是"优先"搭配，不修改，只计数
+            problems["unpaired"] += 1
+        return emotion, gesture
+
+
+def load_gesture_rules(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return GestureRules(json.load(f))
+
+
+gesture_rules = load_gesture_rules(os.getenv("AVATAR_GESTURES_PATH", "avatar_gestures.json"))
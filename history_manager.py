@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+from pydantic import BaseModel
+
+import admission
+import llm_client
+from structured_log import get_logger
+
+log = get_logger("history")
+
+
+# 每个模型的历史预算：最多保留 keep_lines 行原文，且原文总量不超过 max_tokens
+class HistoryBudget(BaseModel):
+    max_tokens: int
+    keep_lines: int
+    summary_max_tokens: int = 200
+
+
+HISTORY_BUDGETS = {
+    "gpt-4o": HistoryBudget(max_tokens=6000, keep_lines=40),
+    "meta-llama-3.1-8b-instruct": HistoryBudget(max_tokens=2500, keep_lines=16),
+    "qwen3-32b": HistoryBudget(max_tokens=4000, keep_lines=24),
+}
+DEFAULT_BUDGET = HistoryBudget(max_tokens=3000, keep_lines=20)
+
+# 例如 HISTORY_BUDGETS='{"gpt-4o": {"max_tokens": 8000, "keep_lines": 48}}'
+for _model, _budget in json.loads(os.getenv("HISTORY_BUDGETS", "{}")).items():
+    HISTORY_BUDGETS[_model] = HistoryBudget(**_budget)
+
+# 摘要只在 SUMMARY_STEP 的整数倍处切分，下一轮需要的摘要可以在本轮结束后提前算好
+SUMMARY_STEP = int(os.getenv("HISTORY_SUMMARY_STEP", "6"))
+
+SUMMARY_PROMPT = """
+You are summarizing the earlier part of a retrospective meeting among CoLive housemates.
+Merge the existing summary (if any) with the new transcript lines into one short summary.
+Keep: which house-rule topics have been discussed, what each housemate proposed or objected to,
+and any decisions reached. Do not invent content. Write plain prose, at most 120 words.
+"""
+
+
+# 粗略估算 token 数（约 4 个字符 1 个 token），只用于预算控制
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+
+# history[:i] 的滚动摘要键：digests[i] 只取决于前 i 行内容，不依赖 session_id
+def prefix_digests(history):
+    digests = [""]
+    running = hashlib.sha1()
+    for line in history:
+        running.update(line.encode("utf-8"))
+        running.update(b"\x00")
+        digests.append(running.hexdigest())
+    return digests
+
+
+class HistoryManager:
+    def __init__(self, max_summaries=1024):
+        self.max_summaries = max_summaries
+        self._summaries = OrderedDict()  # digest -> 摘要文本
+        self._pending = {}  # digest -> 正在计算的 Task
+
+    # 返回 (摘要或 None, 需要原样发送的最近几行)；不会等待摘要计算
+    def window(self, history, provider, model):
+        budget = HISTORY_BUDGETS.get(model, DEFAULT_BUDGET)
+
+        keep = 0
+        tokens = 0
+        for line in reversed(history):
+            tokens += count_tokens(line)
+            if keep >= budget.keep_lines or (keep and tokens > budget.max_tokens):
+                break
+            keep += 1
+
+        cut = len(history) - keep
+        if cut == 0 and len(history) + SUMMARY_STEP <= budget.keep_lines:
+            return None, history
+
+        # 接近窗口上限时就开始准备摘要
+        digests = prefix_digests(history)
+        self._schedule(history, digests, provider, model, budget)
+        if cut == 0:
+            return None, history
+
+        # 切分点向上对齐到 SUMMARY_STEP，保证原文部分不超预算
+        #   最新的摘要还没算好时退回更早的摘要，摘要之后的原文全部保留（行数可以超出 keep_lines，token 不超预算）
+        #   都不满足时不带摘要，只发最近的窗口
+        aligned = min(-(-cut // SUMMARY_STEP) * SUMMARY_STEP, len(history) - 1)
+        tokens = sum(count_tokens(line) for line in history[aligned + 1:])
+        for covered in range(aligned, 0, -1):
+            tokens += count_tokens(history[covered])
+            if covered < cut and tokens > budget.max_tokens:
+                break
+            summary = self._summaries.get(digests[covered])
+            if summary is not None:
+                self._summaries.move_to_end(digests[covered])
+                return f"Summary of the earlier conversation:\n{summary}", history[covered:]
+        return None, history[cut:]
+
+    # 在后台补齐所有对齐切分点的摘要，下一轮请求直接命中
+    def _schedule(self, history, digests, provider, model, budget):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        target = (len(history) // SUMMARY_STEP) * SUMMARY_STEP
+        digest = digests[target]
+        if target == 0 or digest in self._summaries or digest in self._pending:
+            return
+        # 摘要在后台进行，不受触发它的请求的截止时间与会话限制约束
+        task = asyncio.create_task(
+            self._summarize_upto(history[:target], digests, provider, model, budget), context=admission.background_context()
+        )
+        self._pending[digest] = task
+        task.add_done_callback(lambda _: self._pending.pop(digest, None))
+
+    async def _summarize_upto(self, history, digests, provider, model, budget):
+        start = len(history)
+        while start > 0 and digests[start] not in self._summaries:
+            start -= SUMMARY_STEP
+        summary = self._summaries.get(digests[start]) if start > 0 else None
+
+        for end in range(start + SUMMARY_STEP, len(history) + 1, SUMMARY_STEP):
+            try:
+                summary = await self._summarize(summary, history[end - SUMMARY_STEP:end], provider, model, budget)
+            except Exception as e:
+                log.warning("history_summary_failed", error=repr(e))
+                return
+            self._summaries[digests[end]] = summary
+            if len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+
+    async def _summarize(self, summary, lines, provider, model, budget):
+        transcript = "\n".join(lines)
+        content = f"Existing summary:\n{summary}\n\nNew lines:\n{transcript}" if summary else f"New lines:\n{transcript}"
+        response = await llm_client.chat_completion(
+            provider,
+            model=model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": content},
+            ],
+            temperature=0.2,
+            max_tokens=budget.summary_max_tokens,
+        )
+        return response.choices[0].message.content.strip()
+
+
+history_manager = HistoryManager()
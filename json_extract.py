@@ -0,0 +1,110 @@
+import json
+
+WHITESPACE = " \t\r\n"
+
+
+# 增量 JSON 数组解析器：逐块喂入模型输出，数组中每个对象的右花括号一到就返回该对象
+#   单遍线性扫描，容忍：```json 包裹和前言（跳到第一个对象数组）、对象内的尾逗号、
+#   被截断的最后一个对象（finish() 时保留其中完整的字段）
+class JsonArrayStreamParser:
+    def __init__(self):
+        self.in_array = False
+        self.found = False  # 是否遇到过对象数组（含空数组）
+        self.done = False
+        self.items = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.current = []
+        self.comma_at = None  # 最近一个有效字符是逗号时它在 current 中的位置（用于去掉尾逗号）
+        self.field_end = None  # 最外层对象中最后一个逗号的位置（截断时退回到这里）
+
+    def feed(self, text):
+        completed = []
+        for ch in text:
+            if self.done:
+                break
+            if not self.in_array:
+                # 跳过 ```json 之类的前缀，直到遇到数组起点
+                if ch == "[":
+                    self.in_array = True
+                continue
+
+            if self.depth == 0:
+                if ch == "{":
+                    self.found = True
+                    self.depth = 1
+                    self.current = [ch]
+                    self.comma_at = self.field_end = None
+                elif ch == "]":
+                    self.found = True
+                    # 前言里的空数组不算，继续找后面的数组
+                    self.done = self.items > 0
+                    self.in_array = False
+                elif ch != "," and ch not in WHITESPACE:
+                    # 不是对象数组（如前言里的 [note]），重新寻找数组起点
+                    self.in_array = ch == "["
+                continue
+
+            self.current.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if ch in WHITESPACE:
+                continue
+
+            if ch == ",":
+                self.comma_at = len(self.current) - 1
+                if self.depth == 1:
+                    self.field_end = self.comma_at
+                continue
+            if ch in "}]" and self.comma_at is not None:
+                self.current[self.comma_at] = " "
+            self.comma_at = None
+
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        completed.append(json.loads("".join(self.current)))
+                        self.items += 1
+                    except json.JSONDecodeError:
+                        pass
+                    self.current = []
+        return completed
+
+    # 输入结束：最后一个对象被截断时，补上右花括号；字符串被截断时退回到上一个完整字段
+    def finish(self):
+        if not self.in_array or self.done or self.depth != 1:
+            return []
+        candidates = []
+        if not self.in_string:
+            candidates.append("".join(self.current).rstrip(WHITESPACE + ",:") + "}")
+        if self.field_end is not None:
+            candidates.append("".join(self.current[:self.field_end]) + "}")
+        self.done = True
+        for candidate in candidates:
+            try:
+                item = json.loads(candidate)
+            except json.JSONDecodeError:
+                continue
+            self.items += 1
+            return [item]
+        return []
+
+
+# 一次性提取模型输出中的发言列表；找不到对象数组时返回 None
+def extract_dialogue(text):
+    parser = JsonArrayStreamParser()
+    items = parser.feed(text)
+    items += parser.finish()
+    return items if parser.found else None
@@ -0,0 +1,27 @@
+from contextlib import asynccontextmanager
+
+# 各共享组件在导入时注册的启动/关闭钩子（均为无参协程函数）
+_startup_hooks = []
+_shutdown_hooks = []
+
+
+def on_startup(hook):
+    _startup_hooks.append(hook)
+    return hook
+
+
+def on_shutdown(hook):
+    _shutdown_hooks.append(hook)
+    return hook
+
+
+# 所有 FastAPI app 共用的 lifespan：FastAPI(lifespan=lifespan)
+@asynccontextmanager
+async def lifespan(app):
+    for hook in _startup_hooks:
+        await hook()
+    try:
+        yield
+    finally:
+        for hook in reversed(_shutdown_hooks):
+            await hook()
@@ -0,0 +1,88 @@
+import os
+
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+from admission import admission
+import circuit_breaker
+from lifespan import on_shutdown
+import retries
+
+load_dotenv()
+
+# 上游服务：名称 -> API key / base_url 环境变量（创建客户端时才读取，便于压测脚本指向 mock_llm）
+PROVIDERS = {
+    "openai": {
+        "api_key_env": "OPENAI_API_KEY",
+        "base_url_env": "OPENAI_BASE_URL",
+        "default_base_url": None,
+    },
+    "chatai": {
+        "api_key_env": "CHATAI_API_KEY",
+        "base_url_env": "CHATAI_BASE_URL",
+        "default_base_url": "https://chat-ai.academiccloud.de/v1",
+    },
+}
+
+# 连接池参数：一个 worker 上可同时挂起数百个会话
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "512"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "128"))
+KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+
+_http_client = None
+_clients = {}
+
+
+# 进程内共享的 keep-alive 连接池，所有 provider 共用
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10.0),
+        )
+    return _http_client
+
+
+# 按 provider 懒加载 AsyncOpenAI 客户端（缺少 key 时不影响模块导入）
+def get_client(provider):
+    client = _clients.get(provider)
+    if client is None:
+        config = PROVIDERS[provider]
+        client = AsyncOpenAI(
+            api_key=os.getenv(config["api_key_env"]),
+            base_url=os.getenv(config["base_url_env"]) or config["default_base_url"],
+            http_client=get_http_client(),
+            # 重试由 retries 统一处理（共享额度、受截止时间约束），关闭 SDK 自带的重试
+            max_retries=0,
+        )
+        _clients[provider] = client
+    return client
+
+
+# 所有调用上游的统一入口（生成、对冲、预测性生成、历史摘要）；可重试的错误（429 / 5xx / 连接错误）按 retries 的策略重试，
+#   每次尝试先取得该 provider 的准入名额（拿不到时抛 admission.Rejected），再经过它的熔断器（打开时直接抛 CircuitOpen，不重试）
+async def chat_completion(provider, **params):
+    client = get_client(provider)
+    breaker = circuit_breaker.breaker(provider)
+    stream = bool(params.get("stream"))
+
+    async def attempt():
+        return await admission.call(provider, lambda: breaker.call(lambda: client.chat.completions.create(**params)), stream)
+
+    return await retries.call(provider, attempt)
+
+
+@on_shutdown
+async def aclose():
+    global _http_client
+    _clients.clear()
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
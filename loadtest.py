@@ -0,0 +1,184 @@
+"""
+压测 /generate：N 个并发的模拟 Unity 会话，每个会话连续发送若干轮对话。
+
+两种模式:
+  --app MODULE  在本进程内启动模拟上游（mock_llm）和被测服务器（七个版本任选其一）
+  --url URL     压测已运行的服务器（上游需自行指向 mock_llm.py 或真实 provider）
+
+报告 p50/p95/p99 延迟、吞吐与错误率；--stream 时额外报告首条发言的延迟。
+
+用法:
+    python loadtest.py --app colive_server_chatai_sessionid --sessions 50 --turns 5
+    python loadtest.py --app colive_autotalk_server --stream --malformed 0.1 --errors 0.02
+    python loadtest.py --url http://127.0.0.1:8000 --sessions 20
+    python loadtest.py --app colive_unified --variant colive_server_llama --model qwen3-32b
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import time
+import uuid
+
+import httpx
+
+from mock_llm import MockLLM, add_mock_arguments, mock_config_from_args, serve_in_thread
+
+APPS = [
+    "main",
+    "colive_server_chatai",
+    "colive_server_chatai_sessionid",
+    "colive_server_llama",
+    "colive_qwen_chatai",
+    "colive_autotalk_server",
+    "colive_autotalk_server_chatai",
+    "colive_unified",
+]
+
+USER_INPUTS = [
+    "I think we need a clear rule about parties. It's been too loud some nights.",
+    "Can we talk about the dishes? They pile up every weekend.",
+    "I'd like us to split the groceries more fairly.",
+    "Maybe guests should only stay over on weekends?",
+    "What if we had a shared calendar for the living room?",
+]
+
+
+# 按最近秩法取百分位
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+class Results:
+    def __init__(self):
+        self.latencies = []
+        self.first_utterance = []
+        self.errors = {}
+        self.requests = 0
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+# 一个模拟 Unity 会话：字段取各版本 DialogueRequest 的并集，多余字段会被忽略
+async def run_session(client, url, args, results):
+    session_id = uuid.uuid4().hex
+    history = []
+    for turn_id in range(args.turns):
+        payload = {
+            "session_id": session_id,
+            "user_input": USER_INPUTS[turn_id % len(USER_INPUTS)],
+            "history": list(history),
+            "avatars": args.avatars,
+            "participant_role": args.participant,
+            "turn_id": turn_id,
+        }
+        start = time.perf_counter()
+        results.requests += 1
+        try:
+            if args.stream:
+                dialogue = await stream_turn(client, url, payload, start, results)
+            else:
+                response = await client.post(f"{url}/generate", json=payload)
+                if response.status_code != 200:
+                    results.error(f"http {response.status_code}")
+                    continue
+                dialogue = response.json()["dialogue"]
+        except Exception as e:
+            results.error(type(e).__name__)
+            continue
+        results.latencies.append(time.perf_counter() - start)
+
+        history.append(f"{args.participant}: {payload['user_input']}")
+        history.extend(f"{turn.get('speaker')}: {turn.get('text')}" for turn in dialogue)
+        if args.think_time:
+            await asyncio.sleep(args.think_time)
+
+
+async def stream_turn(client, url, payload, start, results):
+    async with client.stream("POST", f"{url}/generate_stream", json=payload) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"http {response.status_code}")
+        event = None
+        first = True
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event == "utterance" and first:
+                    results.first_utterance.append(time.perf_counter() - start)
+                    first = False
+                elif event == "done":
+                    return json.loads(line[len("data: "):])["dialogue"]
+    raise RuntimeError("stream ended without done event")
+
+
+async def run(url, args):
+    results = Results()
+    limits = httpx.Limits(max_connections=args.sessions, max_keepalive_connections=args.sessions)
+    headers = {}
+    if args.variant:
+        headers["X-Colive-Variant"] = args.variant
+    if args.model:
+        headers["X-Colive-Model"] = args.model
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout, headers=headers) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(run_session(client, url, args, results) for _ in range(args.sessions)))
+        elapsed = time.perf_counter() - start
+    report(results, elapsed)
+
+
+def report(results, elapsed):
+    ok = len(results.latencies)
+    failed = results.requests - ok
+    print(f"requests     {results.requests}  ok {ok}  failed {failed}")
+    print(f"elapsed      {elapsed:.2f} s")
+    print(f"throughput   {ok / elapsed:.1f} req/s")
+    print(f"error rate   {failed / max(results.requests, 1):.2%}  {results.errors or ''}")
+    print("latency      " + "  ".join(f"p{p} {percentile(results.latencies, p) * 1000:.0f} ms" for p in (50, 95, 99)))
+    if results.first_utterance:
+        print("first event  " + "  ".join(f"p{p} {percentile(results.first_utterance, p) * 1000:.0f} ms" for p in (50, 95, 99)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--app", choices=APPS, help="在本进程内启动的服务器模块")
+    target.add_argument("--url", help="已运行服务器的地址，如 http://127.0.0.1:8000")
+    parser.add_argument("--sessions", type=int, default=20, help="并发会话数")
+    parser.add_argument("--turns", type=int, default=5, help="每个会话的轮数")
+    parser.add_argument("--think-time", type=float, default=0.0, help="每轮之间的停顿（秒）")
+    parser.add_argument("--stream", action="store_true", help="压测 /generate_stream")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--avatars", nargs="+", default=["Alice", "Benji", "Caden"])
+    parser.add_argument("--participant", default="Alice")
+    parser.add_argument("--variant", help="colive_unified 的 X-Colive-Variant 请求头")
+    parser.add_argument("--model", help="colive_unified 的 X-Colive-Model 请求头")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    url = args.url
+    servers = []
+    if args.app:
+        mock_server, mock_url = serve_in_thread(MockLLM(mock_config_from_args(args)).build_app())
+        servers.append(mock_server)
+        # 必须在第一次请求之前设置：llm_client 在首次创建各 provider 的客户端时读取 base_url
+        os.environ.update(
+            OPENAI_API_KEY="mock", OPENAI_BASE_URL=f"{mock_url}/v1",
+            CHATAI_API_KEY="mock", CHATAI_BASE_URL=f"{mock_url}/v1",
+        )
+        app_server, url = serve_in_thread(importlib.import_module(args.app).app)
+        servers.append(app_server)
+        print(f"{args.app} -> mock upstream ({args.latency}, mean {args.latency_mean}s, {args.tokens_per_sec} tok/s)")
+
+    asyncio.run(run(url.rstrip("/"), args))
+    for server in reversed(servers):
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
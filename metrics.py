@@ -0,0 +1,185 @@
+import contextvars
+import functools
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import backends
+import structured_log
+
+# Prometheus 文本格式的指标：全部在事件循环线程上更新，不加锁；
+#   标签值以元组为 key，热路径上只有一次字典查找和一次加法
+_metrics = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labelnames, labels, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{_label_text(self.labelnames, labels)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [各桶计数..., +Inf 桶计数, 总和]
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    # 导出时才累加成 Prometheus 的累计桶
+    def samples(self):
+        for labels, counts in self._values.items():
+            total = 0
+            for le, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                le_label = f'le="{le}"'
+                yield f"{self.name}_bucket{_label_text(self.labelnames, labels, le_label)} {total}"
+            yield f"{self.name}_sum{_label_text(self.labelnames, labels)} {counts[-1]}"
+            yield f"{self.name}_count{_label_text(self.labelnames, labels)} {total}"
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+requests_total = Counter("colive_requests_total", "HTTP requests by route and status", ("variant", "model", "path", "status"))
+in_flight = Gauge("colive_requests_in_flight", "HTTP requests currently being handled", ("variant", "model"))
+stage_seconds = Histogram(
+    "colive_stage_seconds",
+    "Time spent per stage: prompt, ttft, upstream, parse, log_write",
+    ("variant", "model", "stage"),
+)
+tokens_total = Counter("colive_tokens_total", "Tokens reported by response.usage", ("variant", "model", "type"))
+parse_failures_total = Counter("colive_parse_failures_total", "Replies with no parseable JSON array", ("variant", "model"))
+dropped_turns_total = Counter("colive_dropped_turns_total", "Turns dropped by the speaker / text filter", ("variant", "model", "reason"))
+fallbacks_total = Counter("colive_fallbacks_total", "Replies replaced by a fallback message", ("variant", "model"))
+cancelled_total = Counter("colive_cancelled_generations_total", "Upstream generations cancelled before completion (client disconnect or stale speculation)", ("variant", "model"))
+tokens_saved_total = Counter("colive_tokens_saved_total", "Estimated completion tokens not generated due to cancellation", ("variant", "model"))
+
+# 当前请求的 (variant, model)，由 MetricsMiddleware 设置，供各阶段计时使用
+_labels = contextvars.ContextVar("metrics_labels", default=("", ""))
+
+
+def current_labels():
+    return _labels.get()
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, *_labels.get(), stage)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+# 装饰同步函数（如 build_messages、write_session_log），按阶段计时
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+TRACKED_PATHS = ("/generate", "/generate_stream", "/generate_batch")
+
+
+# ASGI 中间件：请求数、进行中的请求数，并为本次请求设置指标标签（模型按 backends.resolve 解析）；
+#   生成类接口结束时写一条结构化请求日志（耗时、状态、session_id、token 数）
+class MetricsMiddleware:
+    def __init__(self, app, variant, provider, params):
+        self.app = app
+        self.variant = variant
+        self.provider = provider
+        self.params = params
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        _, params = backends.resolve(self.provider, self.params)
+        labels = (self.variant, params["model"])
+        path = next((p for p in TRACKED_PATHS if scope["path"].endswith(p)), "other")
+        status = 500
+
+        async def capture(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = _labels.set(labels)
+        log_token = structured_log.begin_request(variant=self.variant, model=params["model"], path=path)
+        in_flight.inc(*labels)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            fields = structured_log.end_request(log_token)
+            # 客户端在响应开始前断开，按惯例记为 499
+            if fields.get("disconnected") and status == 500:
+                status = 499
+            in_flight.dec(*labels)
+            requests_total.inc(*labels, path, str(status))
+            _labels.reset(token)
+            if path != "other":
+                structured_log.request_log.info(
+                    "request", **fields, status=status, latency_ms=round((time.perf_counter() - start) * 1000, 1)
+                )
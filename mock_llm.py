@@ -0,0 +1,232 @@
+"""
+本地 OpenAI 兼容的模拟上游，用于压测与容量规划（不消耗真实 API 额度）。
+
+- 延迟分布: fixed / uniform / lognormal，可设置均值与离散程度
+- 流式输出: 按 tokens/sec 逐块推送，支持 stream_options.include_usage
+- 回复: 根据 prompt 推断可发言的 avatar，返回合法 JSON；按比例返回畸形回复
+  （截断、markdown 包裹、散文、参与者代言）与 429/500 错误
+- 确定性: 同一 seed 下第 n 个请求的延迟与回复固定
+
+用法:
+    python mock_llm.py --port 9000 --latency lognormal --latency-mean 0.8 --tokens-per-sec 40 --malformed 0.05
+    CHATAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_BASE_URL=http://127.0.0.1:9000/v1 uvicorn colive_server_chatai:app
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import socket
+import threading
+import time
+from typing import List
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+from history_manager import count_tokens
+
+CANNED_TEXTS = [
+    "I think we should write the quiet hours down so nobody has to guess.",
+    "Honestly, a shared calendar for the kitchen would save us a lot of arguments.",
+    "Can we agree on a cleaning rotation before we talk about parties?",
+    "I'm fine with guests, as long as we get a heads-up the day before.",
+    "Let's keep the rules short, or nobody will actually follow them.",
+    "Splitting groceries by receipt feels fairer than a flat monthly fee.",
+]
+EMOTIONS = ["neutral", "happy", "calm", "hopeful", "thinking", "frustrated"]
+GESTURES = ["start talking", "clapping"]  # 三个 avatar 都有的手势
+MALFORMED_KINDS = ["truncated", "markdown", "prose", "participant"]
+
+
+class MockConfig(BaseModel):
+    seed: int = 0
+    latency: str = "fixed"  # fixed / uniform / lognormal
+    latency_mean: float = 0.5  # 秒，首 token 之前的等待
+    latency_spread: float = 0.5  # uniform: ±比例；lognormal: sigma
+    tokens_per_sec: float = 0.0  # 流式推送速率，0 表示一次性推完
+    malformed_ratio: float = 0.0
+    error_ratio: float = 0.0
+    avatars: List[str] = ["Alice", "Benji", "Caden"]
+
+
+# 从 prompt 中推断应发言的 avatar（autotalk 批量模式按给定顺序，单轮指定当前发言人，其余版本排除参与者）
+def pick_speakers(text, avatars):
+    schedule = re.findall(r"^- Turn \d+: (\w+)$", text, re.M)
+    if schedule:
+        return schedule
+    match = re.search(r"it is now \*\*(\w+)\*\*'s turn", text)
+    if match:
+        return [match.group(1)]
+    match = re.search(r"(?:role-playing as:?|plays the role of)\s*\**(\w+)", text)
+    participant = match.group(1) if match else None
+    return [name for name in avatars if name != participant] or avatars
+
+
+class MockLLM:
+    def __init__(self, config):
+        self.config = config
+        self.requests = 0
+
+    # 第 n 个请求使用独立的随机数流，并发下结果也可复现
+    def _rng(self):
+        self.requests += 1
+        return self.requests, random.Random(f"{self.config.seed}:{self.requests}")
+
+    def _latency(self, rng):
+        config = self.config
+        if config.latency == "uniform":
+            return max(0.0, config.latency_mean * (1 + rng.uniform(-config.latency_spread, config.latency_spread)))
+        if config.latency == "lognormal":
+            # 使分布均值等于 latency_mean
+            mu = math.log(config.latency_mean) - config.latency_spread ** 2 / 2
+            return rng.lognormvariate(mu, config.latency_spread)
+        return config.latency_mean
+
+    def _reply(self, rng, messages):
+        text = "\n".join(str(m.get("content", "")) for m in messages)
+        speakers = pick_speakers(text, self.config.avatars)
+        turns = [
+            {
+                "speaker": speaker,
+                "text": rng.choice(CANNED_TEXTS),
+                "emotion": rng.choice(EMOTIONS),
+                "gesture": rng.choice(GESTURES),
+            }
+            for speaker in (speakers if len(speakers) > 2 else speakers[:rng.randint(1, 2)])
+        ]
+        reply = json.dumps(turns, ensure_ascii=False)
+        if rng.random() >= self.config.malformed_ratio:
+            return reply
+
+        kind = rng.choice(MALFORMED_KINDS)
+        if kind == "truncated":
+            return reply[: len(reply) * 2 // 3]
+        if kind == "markdown":
+            return f"```json\n{reply}\n```"
+        if kind == "prose":
+            return f"{speakers[0]}: {turns[0]['text']}"
+        participant = next((name for name in self.config.avatars if name not in speakers), speakers[0])
+        return json.dumps([{**turns[0], "speaker": participant}], ensure_ascii=False)
+
+    def build_app(self):
+        app = FastAPI()
+
+        @app.post("/v1/chat/completions")
+        async def chat_completions(body: dict):
+            request_no, rng = self._rng()
+            latency = self._latency(rng)
+            if rng.random() < self.config.error_ratio:
+                await asyncio.sleep(latency)
+                status = rng.choice([429, 500])
+                return JSONResponse(
+                    {"error": {"message": "mock upstream error", "type": "mock_error", "code": status}},
+                    status_code=status,
+                    headers={"Retry-After": "1"} if status == 429 else None,
+                )
+
+            messages = body.get("messages", [])
+            reply = self._reply(rng, messages)
+            prompt_tokens = sum(count_tokens(str(m.get("content", ""))) for m in messages)
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": count_tokens(reply),
+                "total_tokens": prompt_tokens + count_tokens(reply),
+            }
+            model = body.get("model", "mock")
+            created = int(time.time())
+
+            if not body.get("stream"):
+                await asyncio.sleep(latency)
+                return {
+                    "id": f"mock-{request_no}",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                    "usage": usage,
+                }
+
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+            async def events():
+                await asyncio.sleep(latency)
+                # 约 4 个字符一个 token
+                pieces = [reply[i:i + 4] for i in range(0, len(reply), 4)]
+                for piece in pieces:
+                    chunk = {
+                        "id": f"mock-{request_no}", "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    if self.config.tokens_per_sec > 0:
+                        await asyncio.sleep(1 / self.config.tokens_per_sec)
+                final = {
+                    "id": f"mock-{request_no}", "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+                yield f"data: {json.dumps(final)}\n\n"
+                if include_usage:
+                    usage_chunk = {
+                        "id": f"mock-{request_no}", "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [], "usage": usage,
+                    }
+                    yield f"data: {json.dumps(usage_chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        return app
+
+
+# 在后台线程中启动一个 ASGI 应用，返回 (server, base_url)；压测脚本用它同时拉起模拟上游与被测服务器
+def serve_in_thread(app, port=0):
+    if not port:
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-mean", type=float, default=0.8, help="首 token 前的平均延迟（秒）")
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--tokens-per-sec", type=float, default=40.0)
+    parser.add_argument("--malformed", type=float, default=0.0, help="畸形回复比例")
+    parser.add_argument("--errors", type=float, default=0.0, help="429/500 错误比例")
+
+
+def mock_config_from_args(args):
+    return MockConfig(
+        seed=args.seed,
+        latency=args.latency,
+        latency_mean=args.latency_mean,
+        latency_spread=args.latency_spread,
+        tokens_per_sec=args.tokens_per_sec,
+        malformed_ratio=args.malformed,
+        error_ratio=args.errors,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9000)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(MockLLM(mock_config_from_args(args)).build_app(), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
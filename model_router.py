@@ -0,0 +1,241 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, deque
+
+from admission import Rejected, ReleasingStream, admission
+import backends
+import circuit_breaker
+import deadline
+import llm_client
+import output_schema
+from structured_log import get_logger
+
+log = get_logger("router")
+
+# 每个模型的备用模型（按优先级）；例如 ROUTER_ALTERNATES='{"gpt-4o": ["qwen3-32b"]}'
+ALTERNATES = {
+    "gpt-4o": ["qwen3-32b"],
+    "meta-llama-3.1-8b-instruct": ["qwen3-32b"],
+    "qwen3-32b": ["meta-llama-3.1-8b-instruct"],
+}
+ALTERNATES.update(json.loads(os.getenv("ROUTER_ALTERNATES", "{}")))
+
+EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+LATENCY_WINDOW = int(os.getenv("ROUTER_LATENCY_WINDOW", "200"))
+# 样本不足时不对冲（p95 还不可信）
+MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "20"))
+# 对冲时机：主请求超过 max(p95 * factor, min_delay) 仍未返回
+HEDGE_FACTOR = float(os.getenv("ROUTER_HEDGE_FACTOR", "1.0"))
+HEDGE_MIN_DELAY = float(os.getenv("ROUTER_HEDGE_MIN_DELAY", "0.5"))
+# 每个会话的对冲请求数不超过其请求数的这个比例，避免花费翻倍
+HEDGE_MAX_RATIO = float(os.getenv("ROUTER_HEDGE_MAX_RATIO", "0.25"))
+# 错误率高于此值的备用模型不参与对冲
+MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+
+
+# 单个后端的延迟 EWMA、错误率 EWMA 与最近延迟窗口（用于 p95）
+class BackendStats:
+    def __init__(self):
+        self.requests = 0
+        self.latency_ewma = None
+        self.error_rate = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, latency, error):
+        self.requests += 1
+        self.error_rate += EWMA_ALPHA * (float(error) - self.error_rate)
+        if error:
+            return
+        self.latencies.append(latency)
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += EWMA_ALPHA * (latency - self.latency_ewma)
+
+    def p95(self):
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+# 路由层：主模型超过 p95 截止时间后向备用模型发出对冲请求，先成功者胜出，另一个被取消；
+#   主模型直接报错时改用备用模型（不计入对冲额度）
+#   流式请求以返回响应头（开始推送）为完成，对冲的是首包延迟
+class ModelRouter:
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._backends = {}  # (model, stream) -> BackendStats
+        self._sessions = OrderedDict()  # session_key -> [请求数, 对冲数]
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_capped = 0
+        self.fallbacks = 0
+
+    def _stats(self, model, stream):
+        key = (model, stream)
+        stats = self._backends.get(key)
+        if stats is None:
+            stats = self._backends[key] = BackendStats()
+        return stats
+
+    # 可用的备用模型（按配置顺序）：已注册、错误率不高且所在 provider 的熔断器没有打开
+    def alternates(self, model, stream):
+        result = []
+        for alternate in ALTERNATES.get(model, []):
+            if alternate == model or alternate not in backends.MODELS:
+                continue
+            if not circuit_breaker.breaker(backends.MODELS[alternate]).available():
+                continue
+            stats = self._backends.get((alternate, stream))
+            if stats is not None and stats.error_rate > MAX_ERROR_RATE:
+                continue
+            result.append(alternate)
+        return result
+
+    def _pick_alternate(self, model, stream):
+        candidates = []
+        for rank, alternate in enumerate(self.alternates(model, stream)):
+            stats = self._backends.get((alternate, stream))
+            # 没有样本的备用模型按配置顺序排在最后
+            latency = stats.latency_ewma if stats is not None and stats.latency_ewma is not None else float("inf")
+            candidates.append((latency, rank, alternate))
+        return min(candidates)[2] if candidates else None
+
+    def _deadline(self, model, stream):
+        p95 = self._stats(model, stream).p95()
+        return None if p95 is None else max(p95 * HEDGE_FACTOR, HEDGE_MIN_DELAY)
+
+    def _count_request(self, session_key):
+        entry = self._sessions.get(session_key)
+        if entry is None:
+            entry = self._sessions[session_key] = [0, 0]
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_key)
+        entry[0] += 1
+        return entry
+
+    async def _timed(self, provider, params):
+        stats = self._stats(params["model"], bool(params.get("stream")))
+        start = time.monotonic()
+        try:
+            result = await llm_client.chat_completion(provider, **params)
+        except (asyncio.CancelledError, Rejected):
+            # 没拿到准入名额不算后端出错
+            raise
+        except Exception:
+            stats.record(time.monotonic() - start, error=True)
+            raise
+        latency = time.monotonic() - start
+        stats.record(latency, error=False)
+        # 非流式补全同时用于估计模型的生成速度（流式的在 streaming 中记录）
+        usage = getattr(result, "usage", None)
+        if usage is not None and usage.completion_tokens:
+            deadline.throughput.record(params["model"], latency, usage.completion_tokens)
+        return result
+
+    # session_key: 对冲额度的计数单位；没有 session_id 的版本传 None，共用一个额度
+    #   同一会话同时只有一个生成（admission.claim_session），流式生成占用到流读完或关闭
+    async def complete(self, provider, session_key, **params):
+        session = admission.claim_session(provider)
+        try:
+            result = await self._complete(provider, session_key, **params)
+        except BaseException:
+            admission.release_session(session)
+            raise
+        if params.get("stream"):
+            return ReleasingStream(result, lambda completed: admission.release_session(session))
+        admission.release_session(session)
+        return result
+
+    #   主模型所在 provider 的熔断器打开时，先按 BREAKER_FALLBACKS 换到备用模型
+    async def _complete(self, provider, session_key, **params):
+        provider, params = circuit_breaker.divert(provider, params)
+        model = params["model"]
+        stream = bool(params.get("stream"))
+        entry = self._count_request(session_key)
+        alternate = self._pick_alternate(model, stream)
+        if alternate is None:
+            return await self._timed(provider, params)
+        alternate_params = output_schema.switch_model(params, alternate)
+
+        primary = asyncio.create_task(self._timed(provider, params))
+        try:
+            await asyncio.wait({primary}, timeout=self._deadline(model, stream))
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+
+        if primary.done():
+            if primary.exception() is None:
+                return primary.result()
+            self.fallbacks += 1
+            log.warning("backend_fallback", failed=model, alternate=alternate, error=repr(primary.exception()))
+            return await self._timed(backends.MODELS[alternate], alternate_params)
+
+        if entry[1] >= HEDGE_MAX_RATIO * entry[0]:
+            self.hedges_capped += 1
+            return await primary
+
+        entry[1] += 1
+        self.hedges += 1
+        hedge = asyncio.create_task(self._timed(backends.MODELS[alternate], alternate_params))
+        winner = None
+        try:
+            winner = await self._first_success(primary, hedge)
+            if winner is hedge:
+                self.hedge_wins += 1
+            return winner.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not winner:
+                    await self._discard(task)
+
+    @staticmethod
+    async def _first_success(*tasks):
+        pending = set(tasks)
+        first_failed = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task
+                first_failed = first_failed or task
+        return first_failed
+
+    # 取消落败的请求；已经建立的流式响应需要关闭以释放连接
+    @staticmethod
+    async def _discard(task):
+        if not task.done():
+            task.cancel()
+            return
+        if task.cancelled() or task.exception() is not None:
+            return
+        close = getattr(task.result(), "close", None)
+        if close is not None:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+
+    def stats(self):
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_capped": self.hedges_capped,
+            "fallbacks": self.fallbacks,
+            "backends": {
+                f"{model}{'/stream' if stream else ''}": {
+                    "requests": stats.requests,
+                    "latency_ewma": stats.latency_ewma,
+                    "error_rate": stats.error_rate,
+                    "p95": stats.p95(),
+                }
+                for (model, stream), stats in self._backends.items()
+            },
+        }
+
+
+model_router = ModelRouter()
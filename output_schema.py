@@ -0,0 +1,176 @@
+import functools
+import json
+import os
+from collections import defaultdict
+
+import metrics
+from gesture_rules import gesture_rules
+from json_extract import extract_dialogue
+
+# 支持 response_format=json_schema 的模型；其余模型只做本地校验修复
+# 例如 STRUCTURED_OUTPUT_MODELS='["qwen3-32b"]'（vLLM 等支持 guided decoding 的后端）
+STRUCTURED_OUTPUT_MODELS = {"gpt-4o"} | set(json.loads(os.getenv("STRUCTURED_OUTPUT_MODELS", "[]")))
+
+
+# 允许的发言者各自一个分支：speaker 固定，gesture 只能取该 avatar 的手势
+@functools.lru_cache(maxsize=64)
+def dialogue_schema(speakers):
+    items = [
+        {
+            "type": "object",
+            "properties": {
+                "speaker": {"type": "string", "enum": [speaker]},
+                "text": {"type": "string"},
+                "emotion": {"type": "string", "enum": list(gesture_rules.emotions)},
+                "gesture": {"type": "string", "enum": list(gesture_rules.gestures(speaker))},
+            },
+            "required": ["speaker", "text", "emotion", "gesture"],
+            "additionalProperties": False,
+        }
+        for speaker in speakers
+    ]
+    # 结构化输出要求根节点是对象，数组包在 dialogue 字段里
+    return {
+        "type": "object",
+        "properties": {"dialogue": {"type": "array", "items": items[0] if len(items) == 1 else {"anyOf": items}}},
+        "required": ["dialogue"],
+        "additionalProperties": False,
+    }
+
+
+# 模型支持时附加 response_format；speakers 为本轮允许的发言者
+def completion_params(params, speakers):
+    if params["model"] not in STRUCTURED_OUTPUT_MODELS:
+        return params
+    return {
+        **params,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "dialogue", "strict": True, "schema": dialogue_schema(tuple(speakers))},
+        },
+    }
+
+
+# 换用另一个模型（对冲、降级、截止时间、熔断分流）时按该模型重新整理参数：不支持结构化输出的模型去掉 response_format
+#   换到支持的模型时不补加（没有发言者列表），回复照常由本地校验修复
+def switch_model(params, model):
+    switched = {**params, "model": model}
+    if model not in STRUCTURED_OUTPUT_MODELS:
+        switched.pop("response_format", None)
+    return switched
+
+
+# 解析模型输出：取第一个对象数组（兼容 ```json 包裹、前言、尾逗号、截断，以及结构化输出的 {"dialogue": [...]} 外层），
+#   没有数组时兼容单个对象；无法解析时返回 None
+def parse_reply(raw_reply):
+    items = extract_dialogue(raw_reply or "")
+    if items is not None:
+        return items
+    text = (raw_reply or "").strip().strip("`").strip()
+    if text.startswith("json"):
+        text = text[len("json"):]
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return [data] if isinstance(data, dict) else None
+
+
+# 校验单条发言：发言者或文本不合法时丢弃（None），emotion / gesture 按 gesture_rules 修复
+#   problems: 计数字典，记录发现的问题类型
+def validate_turn(turn, speakers, problems):
+    if not isinstance(turn, dict) or turn.get("speaker") not in speakers:
+        problems["invalid_speaker"] += 1
+        return None
+    text = turn.get("text")
+    if not isinstance(text, str) or not text.strip():
+        problems["empty_text"] += 1
+        return None
+    speaker = turn["speaker"]
+    emotion, gesture = gesture_rules.repair(speaker, turn.get("emotion"), turn.get("gesture"), problems)
+    return {"speaker": speaker, "text": text, "emotion": emotion, "gesture": gesture}
+
+
+# 一次回复的校验过程：逐条 check()，最后用 status() 归类
+#   check() 可传入该条发言单独的 speakers（批量模式下每轮发言者固定）
+class ReplyCheck:
+    def __init__(self, speakers):
+        self.speakers = speakers
+        self.seen = 0
+        self.valid = 0
+        self.repaired = False
+        self.invalid = 0  # 被丢弃或 emotion / gesture 被修改的发言数
+        self.problems = defaultdict(int)
+
+    def check(self, turn, speakers=None):
+        self.seen += 1
+        fixed = validate_turn(turn, self.speakers if speakers is None else speakers, self.problems)
+        if fixed is None or fixed != turn:
+            self.repaired = True
+        if fixed is None or (fixed["emotion"], fixed["gesture"]) != (turn.get("emotion"), turn.get("gesture")):
+            self.invalid += 1
+        if fixed is not None:
+            self.valid += 1
+        return fixed
+
+    def status(self):
+        if self.seen == 0:
+            return "parse_failure"
+        if self.valid == 0:
+            return "empty"
+        return "repaired" if self.repaired else "ok"
+
+
+# 按 (variant, model) 统计回复质量：ok / repaired / empty / parse_failure；
+#   按模型统计逐条发言的问题：invalid_speaker / empty_text / invalid_emotion / invalid_gesture / unpaired
+class OutputStats:
+    def __init__(self):
+        self._counts = defaultdict(lambda: defaultdict(int))
+        self._invalid = defaultdict(lambda: defaultdict(int))
+
+    def record(self, variant, model, status, check=None):
+        self._counts[(variant, model)][status] += 1
+        if status == "parse_failure":
+            metrics.parse_failures_total.inc(variant, model)
+        if check is not None:
+            for reason in ("invalid_speaker", "empty_text"):
+                if check.problems.get(reason):
+                    metrics.dropped_turns_total.inc(variant, model, reason, amount=check.problems[reason])
+            invalid = self._invalid[model]
+            invalid["turns"] += check.seen
+            invalid["invalid_turns"] += check.invalid
+            for problem, count in check.problems.items():
+                invalid[problem] += count
+
+    def stats(self):
+        result = {}
+        for (variant, model), counts in self._counts.items():
+            replies = sum(counts.values())
+            result[f"{variant}/{model}"] = {
+                "replies": replies,
+                **counts,
+                "parse_failure_rate": counts["parse_failure"] / replies if replies else 0.0,
+            }
+        return {
+            "replies": result,
+            "invalid_by_model": {
+                model: {**invalid, "invalid_rate": invalid["invalid_turns"] / invalid["turns"] if invalid["turns"] else 0.0}
+                for model, invalid in self._invalid.items()
+            },
+        }
+
+
+output_stats = OutputStats()
+
+
+# 解析并校验完整回复，返回合法发言列表（可能为空）；无法解析时返回 None
+@metrics.timed("parse")
+def validate_reply(raw_reply, speakers, variant, model):
+    items = parse_reply(raw_reply)
+    if items is None:
+        output_stats.record(variant, model, "parse_failure")
+        return None
+    check = ReplyCheck(speakers)
+    valid = [turn for turn in map(check.check, items) if turn is not None]
+    output_stats.record(variant, model, check.status() if items else "empty", check)
+    return valid
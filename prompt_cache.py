@@ -0,0 +1,51 @@
+import os
+import sys
+from collections import OrderedDict
+
+from avatar_registry import registry
+
+
+# 编译后 system prompt 的 LRU 缓存：同一组输入只构造一次，字符串会被 intern
+class PromptCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # key 需包含决定 prompt 内容的全部输入（variant、角色列表、参与者角色……）
+    def get(self, key, build):
+        entries = self._entries
+        prompt = entries.get(key)
+        if prompt is not None:
+            entries.move_to_end(key)
+            self.hits += 1
+            return prompt
+
+        self.misses += 1
+        prompt = build()
+        if isinstance(prompt, str):
+            prompt = sys.intern(prompt)
+        entries[key] = prompt
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+        return prompt
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+prompt_cache = PromptCache(int(os.getenv("PROMPT_CACHE_SIZE", "256")))
+
+# 角色卡热加载后，所有依赖它的 prompt 都需要重新构造
+registry.add_reload_listener(prompt_cache.clear)
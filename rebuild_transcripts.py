@@ -0,0 +1,66 @@
+"""
+根据 logs/{session_id}.jsonl 中的增量记录重建完整对话。
+
+每条记录只包含一轮的 user_input、response 和 turn 序号；第 n 轮的 history
+由前 n-1 轮依次展开得到（与服务器端会话存储的追加格式一致）。
+旧格式的记录自带完整 history，直接使用。
+
+用法:
+    python rebuild_transcripts.py --logs logs                 # 打印所有会话的完整对话
+    python rebuild_transcripts.py --logs logs --out transcripts  # 每个会话写一个 .txt
+"""
+import argparse
+import glob
+import json
+import os
+
+from session_log import turn_lines
+
+
+# 读取一个会话日志，返回按 turn 排序、补全了 history 的记录列表
+def load_session(path, participant_role="Participant"):
+    with open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda r: r.get("turn", 0))
+
+    history = []
+    turns = []
+    for record in records:
+        if "history" in record:
+            history = list(record["history"] or [])
+        elif record.get("history_len") not in (None, len(history)):
+            print(f"warning: {path} turn {record['turn']} expected {record['history_len']} history lines, rebuilt {len(history)}")
+        turns.append({**record, "history": list(history)})
+        history.extend(turn_lines(record.get("participant_role", participant_role), record["user_input"], record["response"]))
+    return turns, history
+
+
+def load_sessions(log_dir, participant_role="Participant"):
+    sessions = {}
+    for path in sorted(glob.glob(os.path.join(log_dir, "*.jsonl"))):
+        session_id = os.path.splitext(os.path.basename(path))[0]
+        sessions[session_id] = load_session(path, participant_role)
+    return sessions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logs", default="logs")
+    parser.add_argument("--out", help="输出目录；不指定则打印到标准输出")
+    args = parser.parse_args()
+
+    sessions = load_sessions(args.logs)
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+    for session_id, (_, transcript) in sessions.items():
+        if args.out:
+            with open(os.path.join(args.out, f"{session_id}.txt"), "w", encoding="utf-8") as f:
+                f.write("\n".join(transcript) + "\n")
+        else:
+            print(f"=== {session_id} ===")
+            print("\n".join(transcript))
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import email.utils
+import os
+import random
+import time
+
+import openai
+
+import deadline
+import metrics
+from structured_log import get_logger
+
+log = get_logger("retries")
+
+# 单次请求最多尝试的次数（含第一次）
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+# 指数退避：第 n 次重试前等待 uniform(0, min(cap, base * 2^n))（full jitter）
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "2.0"))
+# 共享重试额度：每个请求存入 ratio 个额度，每次重试取出 1 个；额度用完时不再重试，故障期间重试量不超过请求量的这个比例
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_INITIAL = float(os.getenv("RETRY_BUDGET_INITIAL", "10"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "20"))
+
+retries_total = metrics.Counter("colive_upstream_retries_total", "Upstream calls retried, by error class", ("provider", "reason"))
+giveups_total = metrics.Counter(
+    "colive_upstream_retry_giveups_total", "Retryable upstream failures that were not retried, by cause", ("provider", "reason")
+)
+budget_gauge = metrics.Gauge("colive_retry_budget", "Retries currently available in the shared budget", ("provider",))
+
+
+# 错误分类：可重试时返回原因（rate_limited / server_error / timeout / connection / conflict），否则返回 None
+#   与 openai SDK 的判断一致：408 / 409 / 429 / 5xx 与连接错误可以重试，x-should-retry 响应头优先
+def classify(exc):
+    if isinstance(exc, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(exc, openai.APIConnectionError):
+        return "connection"
+    if not isinstance(exc, openai.APIStatusError):
+        return None
+    should_retry = exc.response.headers.get("x-should-retry")
+    if should_retry == "false":
+        return None
+    status = exc.status_code
+    if status == 429:
+        return "rate_limited"
+    if status >= 500:
+        return "server_error"
+    if status == 408:
+        return "timeout"
+    if status == 409:
+        return "conflict"
+    return "server_error" if should_retry == "true" else None
+
+
+# 上游要求的等待时间（秒）：retry-after-ms、retry-after（秒数或 HTTP 日期）；没有时为 None
+def retry_after(exc):
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# 每个 provider 一个令牌桶：请求存入、重试取出
+class RetryBudget:
+    def __init__(self, provider, ratio=RETRY_BUDGET_RATIO, initial=RETRY_BUDGET_INITIAL, maximum=RETRY_BUDGET_MAX):
+        self.provider = provider
+        self.ratio = ratio
+        self.maximum = maximum
+        self.balance = min(initial, maximum)
+        budget_gauge.set(self.balance, provider)
+
+    def deposit(self):
+        self.balance = min(self.maximum, self.balance + self.ratio)
+        budget_gauge.set(self.balance, self.provider)
+
+    def withdraw(self):
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        budget_gauge.set(self.balance, self.provider)
+        return True
+
+
+_budgets = {}
+
+
+def budget(provider):
+    result = _budgets.get(provider)
+    if result is None:
+        result = _budgets[provider] = RetryBudget(provider)
+    return result
+
+
+# 下一次重试前的等待：full jitter 退避，上游给了 Retry-After 时至少等这么久；
+#   等待超过 RETRY_MAX_DELAY 或请求的剩余预算时返回 None（不再重试）
+def backoff(attempt, exc):
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    requested = retry_after(exc)
+    if requested is not None:
+        if requested > RETRY_MAX_DELAY:
+            return None, "retry_after"
+        delay = max(delay, requested)
+    remaining = deadline.remaining()
+    if remaining is not None and delay >= remaining:
+        return None, "deadline"
+    return delay, None
+
+
+# 执行一次上游调用（fn 为无参协程函数），可重试的错误按退避重试；
+#   流式请求在响应头返回后即视为成功，推送中途的错误不重试（已推送的内容无法撤回）
+async def call(provider, fn):
+    bucket = budget(provider)
+    bucket.deposit()
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            reason = classify(e)
+            if reason is None:
+                raise
+            attempt += 1
+            if attempt >= RETRY_MAX_ATTEMPTS:
+                giveups_total.inc(provider, "attempts")
+                raise
+            delay, giveup = backoff(attempt - 1, e)
+            if giveup is None and not bucket.withdraw():
+                giveup = "budget"
+            if giveup is not None:
+                giveups_total.inc(provider, giveup)
+                log.warning("upstream_retry_giveup", provider=provider, reason=reason, giveup=giveup, attempt=attempt)
+                raise
+            retries_total.inc(provider, reason)
+            log.info("upstream_retry", provider=provider, reason=reason, attempt=attempt, delay=round(delay, 3))
+            await asyncio.sleep(delay)
+
+
+def stats():
+    return {provider: {"budget": round(bucket.balance, 2)} for provider, bucket in _budgets.items()}
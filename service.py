@@ -0,0 +1,51 @@
+from fastapi.responses import PlainTextResponse
+
+import circuit_breaker
+import deadline
+import metrics
+import retries
+from admission import AdmissionMiddleware, admission
+from coalescing import IdempotencyMiddleware, coalescer
+from metrics import MetricsMiddleware
+from model_router import model_router
+from output_schema import output_stats
+from prompt_cache import prompt_cache
+from usage_stats import usage_stats
+
+
+# 进程内各共享组件的统计；extra_stats: {名称: 无参函数}，如 autotalk 的预生成统计
+def collect_stats(extra_stats=None):
+    result = {
+        "prompt_cache": prompt_cache.stats(),
+        "usage": usage_stats.stats(),
+        "router": model_router.stats(),
+        "coalescing": coalescer.stats(),
+        "output": output_stats.stats(),
+        "admission": admission.stats(),
+        "deadline": deadline.stats(),
+        "retries": retries.stats(),
+        "breakers": circuit_breaker.stats(),
+    }
+    for name, fn in (extra_stats or {}).items():
+        result[name] = fn()
+    return result
+
+
+# /stats 与 /metrics（Prometheus 指标，全部 variant 共用一个进程内注册表）
+def add_stats_routes(app, extra_stats=None):
+    @app.get("/stats")
+    async def stats():
+        return collect_stats(extra_stats)
+
+    @app.get("/metrics")
+    async def prometheus_metrics():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# 每个 variant 的 app 共用的中间件与统计接口
+def install(app, variant, provider, params, extra_stats=None):
+    # 由内到外：准入控制 -> 幂等重放 -> 指标
+    app.add_middleware(AdmissionMiddleware)
+    app.add_middleware(IdempotencyMiddleware)
+    app.add_middleware(MetricsMiddleware, variant=variant, provider=provider, params=params)
+    add_stats_routes(app, extra_stats)
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+
+from lifespan import on_shutdown, on_startup
+from structured_log import get_logger
+
+log = get_logger("session_log")
+
+
+# 一轮对话追加到会话历史的行：参与者输入 + 每条 avatar 回复（重建工具与会话存储共用同一格式）
+def turn_lines(participant_role, user_input, reply):
+    lines = [f"{participant_role}: {user_input}"]
+    lines.extend(f"{turn.get('speaker')}: {turn.get('text')}" for turn in reply)
+    return lines
+
+
+# 后台会话日志：请求只把增量记录放进有界队列，写盘、批量合并、定期 fsync 都在后台完成
+#   每条记录只含本轮的输入与回复，外加 turn 序号；完整对话用 rebuild_transcripts.py 重建
+class SessionLogWriter:
+    def __init__(self, log_dir="logs", queue_size=10000, batch_size=256, fsync_interval=1.0, max_open_files=128):
+        self.log_dir = log_dir
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.max_open_files = max_open_files
+        self.dropped = 0
+        self._queue = None
+        self._task = None
+        self._files = OrderedDict()  # session_id -> [file, 下一个 turn 序号]
+        self._dirty = set()
+        self._last_fsync = time.monotonic()
+
+    # 不阻塞请求：队列满时丢弃并计数
+    def write(self, session_id, participant_role, user_input, history_len, response):
+        if self._task is None:
+            self._start()
+        record = {
+            "session_id": session_id,
+            "participant_role": participant_role,
+            "user_input": user_input,
+            "history_len": history_len,
+            "response": response,
+        }
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log.warning("session_log_dropped", session_id=session_id, dropped=self.dropped)
+
+    def _start(self):
+        self._queue = asyncio.Queue(self.queue_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                record = await asyncio.wait_for(self._queue.get(), self.fsync_interval)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._sync)
+                continue
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            stop = batch[-1] is None
+            records = [r for r in batch if r is not None]
+            try:
+                await asyncio.to_thread(self._write_batch, records)
+            except Exception as e:
+                log.error("session_log_write_failed", error=repr(e))
+            if stop:
+                return
+
+    # ---- 以下在工作线程中执行 ----
+
+    def _open(self, session_id):
+        entry = self._files.get(session_id)
+        if entry is not None:
+            self._files.move_to_end(session_id)
+            return entry
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        path = os.path.join(self.log_dir, f"{session_id}.jsonl")
+        turns = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                turns = sum(1 for _ in f)
+        entry = self._files[session_id] = [open(path, "a", encoding="utf-8"), turns]
+        while len(self._files) > self.max_open_files:
+            old_id, (old_file, _) = self._files.popitem(last=False)
+            self._close(old_id, old_file)
+        return entry
+
+    def _close(self, session_id, f):
+        if session_id in self._dirty:
+            f.flush()
+            os.fsync(f.fileno())
+            self._dirty.discard(session_id)
+        f.close()
+
+    def _write_batch(self, records):
+        touched = set()
+        for record in records:
+            entry = self._open(record["session_id"])
+            record["turn"] = entry[1]
+            entry[1] += 1
+            entry[0].write(json.dumps(record, ensure_ascii=False) + "\n")
+            touched.add(record["session_id"])
+        for session_id in touched:
+            entry = self._files.get(session_id)
+            if entry is not None:
+                entry[0].flush()
+                self._dirty.add(session_id)
+        if time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._sync()
+
+    def _sync(self):
+        for session_id in list(self._dirty):
+            entry = self._files.get(session_id)
+            if entry is not None:
+                os.fsync(entry[0].fileno())
+        self._dirty.clear()
+        self._last_fsync = time.monotonic()
+
+    def _close_all(self):
+        while self._files:
+            session_id, (f, _) = self._files.popitem(last=False)
+            self._close(session_id, f)
+
+    # ---- 生命周期 ----
+
+    async def start(self):
+        if self._task is None:
+            self._start()
+
+    # 写完队列中剩余的记录后关闭所有文件
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._queue = None
+        await asyncio.to_thread(self._close_all)
+
+
+session_log = SessionLogWriter(
+    log_dir=os.getenv("SESSION_LOG_DIR", "logs"),
+    queue_size=int(os.getenv("SESSION_LOG_QUEUE", "10000")),
+    batch_size=int(os.getenv("SESSION_LOG_BATCH", "256")),
+    fsync_interval=float(os.getenv("SESSION_LOG_FSYNC_INTERVAL", "1.0")),
+    max_open_files=int(os.getenv("SESSION_LOG_MAX_OPEN", "128")),
+)
+on_startup(session_log.start)
+on_shutdown(session_log.stop)
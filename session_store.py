@@ -0,0 +1,139 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from lifespan import on_shutdown, on_startup
+
+
+# 可选的 SQLite 持久层：每行历史一条记录，追加只写增量，重启后会话仍可恢复
+class SQLiteSessionTier:
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = None
+
+    # 懒连接：关闭后再次使用会重新打开
+    @property
+    def _conn(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS session_turns ("
+                    " session_id TEXT NOT NULL,"
+                    " seq INTEGER NOT NULL,"
+                    " line TEXT NOT NULL,"
+                    " created_at REAL NOT NULL,"
+                    " PRIMARY KEY (session_id, seq))"
+                )
+        return self._db
+
+    def load(self, session_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT line FROM session_turns WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        return [line for (line,) in rows] if rows else None
+
+    def _insert(self, session_id, start_seq, lines):
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO session_turns (session_id, seq, line, created_at) VALUES (?, ?, ?, ?)",
+            [(session_id, start_seq + i, line, now) for i, line in enumerate(lines)],
+        )
+
+    def append(self, session_id, start_seq, lines):
+        with self._lock, self._conn:
+            self._insert(session_id, start_seq, lines)
+
+    def replace(self, session_id, lines):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM session_turns WHERE session_id = ?", (session_id,))
+            self._insert(session_id, 0, lines)
+
+    # 删除最后一次写入早于 ttl 的会话
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM session_turns WHERE session_id IN ("
+                " SELECT session_id FROM session_turns GROUP BY session_id HAVING MAX(created_at) < ?)",
+                (cutoff,),
+            )
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# 按 session_id 保存对话历史：内存层 TTL + LRU 淘汰，可选 SQLite 层兜底
+class SessionStore:
+    def __init__(self, ttl=3600.0, max_sessions=10000, disk=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.disk = disk
+        self._sessions = OrderedDict()  # session_id -> (history, last_access)
+
+    def _evict(self, now):
+        sessions = self._sessions
+        while sessions:
+            session_id, (_, last_access) = next(iter(sessions.items()))
+            if len(sessions) <= self.max_sessions and now - last_access <= self.ttl:
+                break
+            sessions.popitem(last=False)
+
+    def _touch(self, session_id, history):
+        now = time.monotonic()
+        self._sessions[session_id] = (history, now)
+        self._sessions.move_to_end(session_id)
+        self._evict(now)
+
+    async def get_history(self, session_id):
+        entry = self._sessions.get(session_id)
+        if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+            history = entry[0]
+        elif self.disk is not None:
+            history = await asyncio.to_thread(self.disk.load, session_id) or []
+        else:
+            history = []
+        self._touch(session_id, history)
+        return list(history)
+
+    # 追加一轮对话（参与者输入 + avatar 回复）
+    async def append(self, session_id, lines):
+        history = await self.get_history(session_id)
+        start_seq = len(history)
+        history.extend(lines)
+        self._touch(session_id, history)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.append, session_id, start_seq, lines)
+
+    # 客户端仍上传完整 history 时，以客户端为准覆盖服务器端记录
+    async def replace(self, session_id, history):
+        self._touch(session_id, list(history))
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.replace, session_id, list(history))
+
+    async def start(self):
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.purge_expired)
+
+    async def stop(self):
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.close)
+
+
+_db_path = os.getenv("SESSION_DB_PATH")
+session_store = SessionStore(
+    ttl=float(os.getenv("SESSION_TTL", "3600")),
+    max_sessions=int(os.getenv("SESSION_MAX", "10000")),
+    disk=SQLiteSessionTier(_db_path, ttl=float(os.getenv("SESSION_DB_TTL", "604800"))) if _db_path else None,
+)
+on_startup(session_store.start)
+on_shutdown(session_store.stop)
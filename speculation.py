@@ -0,0 +1,78 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import admission
+from lifespan import on_shutdown
+
+
+# 下一轮请求的指纹：角色列表 + 轮次 + 完整 history
+def history_key(avatars, turn_id, history):
+    payload = json.dumps([avatars, turn_id, history], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+# 预测性生成缓冲：每个会话最多一个后台生成的下一轮结果
+#   take() 时指纹一致则直接使用；不一致说明 history 已分叉，取消后台调用
+class SpeculationBuffer:
+    def __init__(self, ttl=60.0, max_sessions=1000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._entries = OrderedDict()  # session_key -> (预期指纹, Task, 过期时间)
+        self.started = 0
+        self.hits = 0
+        self.invalidated = 0
+
+    def start(self, session_key, expected_key, make_coro):
+        self._cancel(session_key)
+        # 后台生成不受触发它的请求的截止时间与会话限制约束
+        task = asyncio.create_task(make_coro(), context=admission.background_context())
+        # 没人取用的失败结果不需要报 "exception was never retrieved"
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._entries[session_key] = (expected_key, task, time.monotonic() + self.ttl)
+        self.started += 1
+        while len(self._entries) > self.max_sessions:
+            _, (_, old_task, _) = self._entries.popitem(last=False)
+            old_task.cancel()
+
+    # 返回可 await 的后台 Task；没有可用结果时返回 None
+    def take(self, session_key, actual_key):
+        entry = self._entries.pop(session_key, None)
+        if entry is None:
+            return None
+        expected_key, task, expires = entry
+        if expected_key != actual_key or expires < time.monotonic():
+            task.cancel()
+            self.invalidated += 1
+            return None
+        self.hits += 1
+        return task
+
+    def _cancel(self, session_key):
+        entry = self._entries.pop(session_key, None)
+        if entry is not None:
+            entry[1].cancel()
+
+    async def clear(self):
+        while self._entries:
+            _, (_, task, _) = self._entries.popitem(last=False)
+            task.cancel()
+
+    def stats(self):
+        return {
+            "pending": len(self._entries),
+            "started": self.started,
+            "hits": self.hits,
+            "invalidated": self.invalidated,
+        }
+
+
+SPECULATE = os.getenv("AUTOTALK_SPECULATE", "1") == "1"
+speculation = SpeculationBuffer(
+    ttl=float(os.getenv("SPECULATION_TTL", "60")),
+    max_sessions=int(os.getenv("SPECULATION_MAX_SESSIONS", "1000")),
+)
+on_shutdown(speculation.clear)
@@ -0,0 +1,149 @@
+import asyncio
+import inspect
+import json
+import time
+
+from fastapi.responses import StreamingResponse
+import httpx
+import openai
+
+import deadline
+from json_extract import JsonArrayStreamParser
+import metrics
+from model_router import model_router
+import output_schema
+import structured_log
+from usage_stats import usage_stats
+
+log = structured_log.get_logger("streaming")
+
+
+# 推送中途的上游错误（连接中断、流中的 error 事件）：已收到的内容保留，按输出提前结束处理
+STREAM_ERRORS = (openai.APIError, httpx.HTTPError)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# 取得第一个事件后才返回 StreamingResponse：上游在开始推送前就失败（名额不足、熔断、重试耗尽）时，
+#   异常在响应开始前抛出，由 AdmissionMiddleware 返回 429 / 503 + Retry-After，而不是中断已经开始的 SSE 流
+async def sse_response(events):
+    first = await anext(events)
+
+    async def chained():
+        yield first
+        async for event in events:
+            yield event
+
+    return StreamingResponse(chained(), media_type="text/event-stream")
+
+
+# 以 SSE 形式推送每条发言：utterance 事件逐条发送，done 事件携带完整 dialogue
+#   speakers: 允许的发言者；每条发言经 output_schema 校验修复，不合法的丢弃
+#   fallback: raw_reply -> 发言列表，没有任何有效发言时使用
+#   on_complete: 结束时以最终 dialogue 回调（如写日志），可以是协程函数
+#   variant: 用于 usage 统计（最后一个 chunk 携带 usage）
+#   session_key: 路由层的对冲额度计数单位
+#   prefetched: 已在后台生成的完整补全（Task），可用时直接按它推送，失败时再请求上游
+async def stream_dialogue(provider, messages, fallback, speakers=None, on_complete=None, variant=None, session_key=None,
+                          prefetched=None, **params):
+    parser = JsonArrayStreamParser()
+    check = output_schema.ReplyCheck(speakers) if speakers is not None else None
+    raw_parts = []
+    dialogue = []
+
+    async def deltas():
+        if prefetched is not None:
+            try:
+                response = await deadline.within(prefetched)
+            except Exception as e:
+                log.warning("prefetched_completion_failed", error=repr(e))
+            else:
+                yield response.choices[0].message.content or ""
+                return
+
+        start = time.perf_counter()
+        generated = 0  # 收到的内容 chunk 数，约等于补全 token 数
+        ttft = None
+        stream = None
+        # 预算不够时在请求上游之前就放弃，不算作取消的生成
+        stream_provider, stream_params = deadline.plan(provider, params, model_router.alternates(params["model"], True))
+        try:
+            stream = await deadline.within(model_router.complete(
+                stream_provider, session_key, messages=messages, stream=True, stream_options={"include_usage": True}, **stream_params
+            ))
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await deadline.within(chunks.__anext__())
+                except StopAsyncIteration:
+                    break
+                except STREAM_ERRORS as e:
+                    log.warning("upstream_stream_interrupted", error=repr(e), generated=generated)
+                    break
+                if chunk.usage is not None:
+                    usage_stats.record(variant, params.get("model"), chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                        metrics.observe_stage("ttft", ttft)
+                    generated += 1
+                    yield delta
+        except (asyncio.CancelledError, GeneratorExit, deadline.DeadlineExceeded):
+            # 客户端断开或截止时间已到：关闭上游连接，上游随之停止生成
+            usage_stats.record_cancelled(variant, params.get("model"), generated, stream_params.get("max_tokens"))
+            raise
+        finally:
+            if stream is not None:
+                await stream.close()
+        elapsed = time.perf_counter() - start
+        metrics.observe_stage("upstream", elapsed)
+        if ttft is not None:
+            deadline.throughput.record(stream_params["model"], elapsed, generated, ttft)
+
+    def accepted(turns):
+        for turn in turns:
+            if check is not None:
+                turn = check.check(turn)
+            if isinstance(turn, dict):
+                dialogue.append(turn)
+                yield sse_event("utterance", turn)
+
+    # 解析与校验是增量进行的，累计耗时，结束时记一次 parse
+    #   截止时间已到时停止接收，已推送的发言保留
+    parse_time = 0.0
+    timed_out = False
+    try:
+        async for delta in deltas():
+            raw_parts.append(delta)
+            start = time.perf_counter()
+            events = list(accepted(parser.feed(delta)))
+            parse_time += time.perf_counter() - start
+            for event in events:
+                yield event
+    except deadline.DeadlineExceeded:
+        timed_out = True
+    # 输出被截断（如命中 stop 序列）时保留最后一条发言中完整的部分
+    for event in accepted(parser.finish()):
+        yield event
+    metrics.observe_stage("parse", parse_time)
+    structured_log.log_raw_reply("".join(raw_parts))
+
+    # 被截止时间打断的输出不计入模型的格式统计
+    if check is not None and not timed_out:
+        output_schema.output_stats.record(variant, params.get("model"), check.status(), check)
+    if not dialogue:
+        metrics.fallbacks_total.inc(variant, params.get("model"))
+        dialogue = deadline.stall_reply(speakers) if timed_out and speakers else fallback("".join(raw_parts))
+        for turn in dialogue:
+            yield sse_event("utterance", turn)
+
+    if on_complete is not None:
+        result = on_complete(dialogue)
+        if inspect.isawaitable(result):
+            await result
+    yield sse_event("done", {"dialogue": dialogue})
@@ -0,0 +1,153 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+from lifespan import on_shutdown, on_startup
+
+# 所有 logger 都在 "colive" 之下；LOG_LEVELS 按名称单独设置级别，
+#   例如 LOG_LEVELS='{"raw": "OFF", "request": "WARNING"}' 在生产环境关闭原始输出和逐请求记录
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = json.loads(os.getenv("LOG_LEVELS", "{}"))
+# 原始模型输出的采样比例（0 关闭，1 全部记录）
+RAW_LOG_SAMPLE_RATE = float(os.getenv("RAW_LOG_SAMPLE_RATE", "1.0"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+OFF = logging.CRITICAL + 1
+
+
+# 一行一个 JSON：时间、级别、logger、事件名，加上结构化字段
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+# 事件循环上只做入队：队列满时丢弃并计数，格式化和写 stdout 都在监听线程里
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # 同进程内传递，不需要提前格式化
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _level(name):
+    return OFF if str(name).upper() == "OFF" else str(name).upper()
+
+
+_queue = queue.Queue(LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(_queue)
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(JsonFormatter())
+_listener = logging.handlers.QueueListener(_queue, _stream_handler)
+
+_root = logging.getLogger("colive")
+_root.addHandler(queue_handler)
+_root.setLevel(_level(LOG_LEVEL))
+_root.propagate = False
+for _name, _value in LOG_LEVELS.items():
+    logging.getLogger(_name if _name.startswith("colive") else f"colive.{_name}").setLevel(_level(_value))
+
+
+@on_startup
+async def start():
+    if _listener._thread is None:
+        _listener.start()
+
+
+# 关闭时写完队列中剩余的记录
+@on_shutdown
+async def stop():
+    if _listener._thread is not None:
+        _listener.stop()
+
+
+# 当前请求的上下文字段（variant / model / path / session_id / token 数），由 MetricsMiddleware 建立
+_request = contextvars.ContextVar("request_log", default=None)
+CONTEXT_FIELDS = ("variant", "model", "session_id")
+
+
+def begin_request(**fields):
+    return _request.set(dict(fields))
+
+
+def end_request(token):
+    fields = _request.get()
+    _request.reset(token)
+    return fields
+
+
+# 补充当前请求的字段（如 session_id）；不在请求中时忽略
+def annotate(**fields):
+    current = _request.get()
+    if current is not None:
+        current.update(fields)
+
+
+def add_usage(prompt_tokens, completion_tokens):
+    current = _request.get()
+    if current is not None:
+        current["prompt_tokens"] = current.get("prompt_tokens", 0) + prompt_tokens
+        current["completion_tokens"] = current.get("completion_tokens", 0) + completion_tokens
+
+
+# 结构化 logger：log.info("event", key=value, ...)，自动带上当前请求的 variant / model / session_id
+class StructuredLogger:
+    def __init__(self, name):
+        self.logger = logging.getLogger(f"colive.{name}")
+
+    def _log(self, level, event, fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        current = _request.get()
+        if current is not None:
+            fields = {**{key: current[key] for key in CONTEXT_FIELDS if key in current}, **fields}
+        self.logger.log(level, event, extra={"fields": fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+
+def get_logger(name):
+    return StructuredLogger(name)
+
+
+request_log = get_logger("request")
+raw_log = get_logger("raw")
+
+
+# 原始模型输出：按 RAW_LOG_SAMPLE_RATE 采样，colive.raw 级别高于 INFO 时完全跳过
+def log_raw_reply(raw_reply):
+    if RAW_LOG_SAMPLE_RATE < 1.0 and random.random() >= RAW_LOG_SAMPLE_RATE:
+        return
+    raw_log.info("raw_reply", raw=raw_reply)
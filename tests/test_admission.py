@@ -0,0 +1,112 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+import admission
+from admission import AdmissionController, AdmissionMiddleware, BackendGate, Rejected
+
+
+# 生成接口：先检查会话，再在 provider "test" 的名额内等待 release 事件
+def gated_app(controller, release):
+    app = FastAPI()
+
+    @app.post("/generate")
+    async def generate(body: dict):
+        session = controller.claim_session("test")
+        try:
+            return await controller.call("test", release.wait)
+        finally:
+            controller.release_session(session)
+
+    app.add_middleware(AdmissionMiddleware)
+    return app
+
+
+async def post_all(app, bodies, release, delay=0.05):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        tasks = [asyncio.create_task(client.post("/generate", json=body)) for body in bodies]
+        await asyncio.sleep(delay)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+
+def test_busy_session_gets_429():
+    controller = AdmissionController({"test": 4})
+
+    async def run():
+        release = asyncio.Event()
+        return await post_all(gated_app(controller, release), [{"session_id": "s1"}, {"session_id": "s1"}, {"session_id": "s2"}], release)
+
+    first, second, other = asyncio.run(run())
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert int(second.headers["Retry-After"]) >= 1
+    assert other.status_code == 200
+    assert controller.stats()["sessions_in_flight"] == 0
+
+
+def test_queue_timeout_gets_503_with_retry_after(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_WAIT", 0.02)
+    controller = AdmissionController({"test": 1})
+
+    async def run():
+        release = asyncio.Event()
+        return await post_all(gated_app(controller, release), [{}, {}], release)
+
+    first, second = asyncio.run(run())
+    assert first.status_code == 200
+    assert second.status_code == 503
+    assert second.json()["detail"] == "upstream busy (timeout), retry later"
+    assert int(second.headers["Retry-After"]) >= 1
+    assert controller.gate("test").stats()["active"] == 0
+
+
+def test_full_queue_is_rejected_immediately():
+    async def run():
+        gate = BackendGate("test", limit=1, max_queue=1)
+        await gate.acquire(1)
+        waiting = asyncio.create_task(gate.acquire(1))
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as excinfo:
+            await gate.acquire(1)
+        gate.release(0.1)
+        await waiting
+        gate.release(0.1)
+        return excinfo.value, gate.stats()
+
+    rejected, stats = asyncio.run(run())
+    assert (rejected.status, rejected.reason) == (503, "queue_full")
+    assert stats["active"] == 0 and stats["queued"] == 0
+
+
+# 名额按先来先到交给排队者；取消的调用不计入占用时长
+def test_slots_are_handed_over_in_order_and_cancelled_calls_are_not_timed():
+    async def run():
+        controller = AdmissionController({"test": 1})
+        order = []
+
+        async def work(name, seconds):
+            order.append(name)
+            await asyncio.sleep(seconds)
+
+        first = asyncio.create_task(controller.call("test", lambda: work("a", 0.02)))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(controller.call("test", lambda: work("b", 0)))
+        third = asyncio.create_task(controller.call("test", lambda: work("c", 0)))
+        await asyncio.sleep(0)
+        await asyncio.gather(first, second, third)
+        service_time = controller.gate("test").service_time
+
+        slow = asyncio.create_task(controller.call("test", lambda: work("d", 10)))
+        await asyncio.sleep(0.01)
+        slow.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await slow
+        return order, service_time, controller.gate("test")
+
+    order, service_time, gate = asyncio.run(run())
+    assert order == ["a", "b", "c", "d"]
+    assert gate.service_time == service_time
+    assert gate.active == 0
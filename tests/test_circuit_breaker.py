@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+
+
+def status_error(status):
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    return openai.APIStatusError("upstream error", response=httpx.Response(status, request=request), body=None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    monkeypatch.setattr(circuit_breaker, "BREAKER_MIN_REQUESTS", 4)
+    monkeypatch.setattr(circuit_breaker, "BREAKER_OPEN_SECONDS", 10.0)
+    monkeypatch.setattr(circuit_breaker, "BREAKER_PROBES", 2)
+    monkeypatch.setattr(circuit_breaker, "BREAKER_CLOSE_AFTER", 3)
+    return now
+
+
+async def succeed():
+    return "ok"
+
+
+async def fail():
+    raise status_error(503)
+
+
+def call(breaker, fn):
+    return asyncio.run(breaker.call(fn))
+
+
+def test_open_half_open_closed_cycle(clock):
+    breaker = CircuitBreaker("test")
+    for _ in range(4):
+        with pytest.raises(openai.APIStatusError):
+            call(breaker, fail)
+    assert breaker.state == OPEN
+
+    # 打开期间直接失败，不调用上游
+    calls = []
+
+    async def tracked():
+        calls.append(1)
+        return "ok"
+
+    with pytest.raises(CircuitOpen) as excinfo:
+        call(breaker, tracked)
+    assert not calls
+    assert excinfo.value.retry_after == 10
+
+    # 冷却结束后半开，连续成功 BREAKER_CLOSE_AFTER 次后关闭
+    clock[0] += 10
+    assert breaker.available()
+    assert breaker.state == HALF_OPEN
+    for _ in range(3):
+        assert call(breaker, succeed) == "ok"
+    assert breaker.state == CLOSED
+    assert breaker.open_seconds == 10.0
+
+
+def test_failed_probe_reopens_with_a_longer_cooldown(clock):
+    breaker = CircuitBreaker("test")
+    for _ in range(4):
+        with pytest.raises(openai.APIStatusError):
+            call(breaker, fail)
+    clock[0] += 10
+    with pytest.raises(openai.APIStatusError):
+        call(breaker, fail)
+    assert breaker.state == OPEN
+    assert breaker.open_seconds == 20.0
+
+
+# 半开时只放行 BREAKER_PROBES 个并发探测
+def test_half_open_limits_concurrent_probes(clock):
+    breaker = CircuitBreaker("test")
+    breaker._open()
+    clock[0] += 10
+    assert breaker.before_call() and breaker.before_call()
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    breaker.release(True)
+    assert breaker.available()
+
+
+# 不可重试的错误（如 400）不算上游故障
+def test_client_errors_do_not_open_the_circuit(clock):
+    async def bad_request():
+        raise status_error(400)
+
+    breaker = CircuitBreaker("test")
+    for _ in range(6):
+        with pytest.raises(openai.APIStatusError):
+            call(breaker, bad_request)
+    assert breaker.state == CLOSED
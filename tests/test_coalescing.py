@@ -0,0 +1,143 @@
+import asyncio
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from coalescing import IdempotencyMiddleware, SingleFlight, request_key
+
+
+def test_concurrent_identical_calls_are_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(*(flight.run("k", fn) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["result"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"calls": 1, "coalesced": 4, "cache_hits": 0, "in_flight": 0}
+
+
+# 一个等待者取消不影响其他等待者拿到结果
+def test_cancelled_waiter_does_not_cancel_the_call():
+    flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.02)
+        return "result"
+
+    async def run():
+        first = asyncio.create_task(flight.run("k", fn))
+        second = asyncio.create_task(flight.run("k", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == "result"
+
+
+def test_result_cache_expires_after_ttl():
+    flight = SingleFlight(ttl=0.05)
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        first = await flight.run("k", fn)
+        cached = await flight.run("k", fn)
+        await asyncio.sleep(0.06)
+        return first, cached, await flight.run("k", fn)
+
+    assert asyncio.run(run()) == (1, 1, 2)
+    assert flight.cache_hits == 1
+
+
+# 失败的调用不缓存，下一次重新执行
+def test_failures_are_not_cached():
+    flight = SingleFlight(ttl=10)
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("upstream failed")
+        return "ok"
+
+    async def run():
+        try:
+            await flight.run("k", fn)
+        except RuntimeError:
+            pass
+        return await flight.run("k", fn)
+
+    assert asyncio.run(run()) == "ok"
+    assert len(calls) == 2
+
+
+def test_request_key_ignores_dict_order():
+    assert request_key("chatai", {"a": 1, "b": [1, 2]}) == request_key("chatai", {"b": [1, 2], "a": 1})
+    assert request_key("chatai", {"a": 1}) != request_key("openai", {"a": 1})
+
+
+def idempotent_app():
+    app = FastAPI()
+    calls = []
+
+    @app.post("/generate")
+    async def generate(body: dict):
+        calls.append(body)
+        return {"call": len(calls), "echo": body}
+
+    app.add_middleware(IdempotencyMiddleware)
+    return app, calls
+
+
+def test_idempotency_key_replays_the_first_response():
+    app, calls = idempotent_app()
+    client = TestClient(app)
+    headers = {"Idempotency-Key": "abc"}
+    first = client.post("/generate", json={"x": 1}, headers=headers)
+    second = client.post("/generate", json={"x": 1}, headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json() == {"call": 1, "echo": {"x": 1}}
+    assert len(calls) == 1
+
+    # 不带 key 或换一个 key 照常执行
+    assert client.post("/generate", json={"x": 1}).json()["call"] == 2
+    assert client.post("/generate", json={"x": 1}, headers={"Idempotency-Key": "def"}).json()["call"] == 3
+
+
+def test_idempotency_key_with_a_different_body_is_rejected():
+    app, calls = idempotent_app()
+    client = TestClient(app)
+    headers = {"Idempotency-Key": "abc"}
+    assert client.post("/generate", json={"x": 1}, headers=headers).status_code == 200
+    response = client.post("/generate", json={"x": 2}, headers=headers)
+    assert response.status_code == 422
+    assert len(calls) == 1
+
+
+# 第一次请求失败时不缓存，同一个 key 重新执行
+def test_failed_response_is_not_replayed():
+    app = FastAPI()
+    calls = []
+
+    @app.post("/generate")
+    async def generate():
+        calls.append(1)
+        if len(calls) == 1:
+            raise HTTPException(503)
+        return {"call": len(calls)}
+
+    app.add_middleware(IdempotencyMiddleware)
+    client = TestClient(app)
+    headers = {"Idempotency-Key": "abc"}
+    assert client.post("/generate", headers=headers).status_code == 503
+    assert client.post("/generate", headers=headers).json() == {"call": 2}
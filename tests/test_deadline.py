@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+import deadline
+from deadline import DeadlineExceeded, ThroughputEstimator
+
+PARAMS = {"model": "test-model", "max_tokens": 400}
+
+
+@pytest.fixture
+def estimator(monkeypatch):
+    result = ThroughputEstimator()
+    monkeypatch.setattr(deadline, "throughput", result)
+    monkeypatch.setattr(deadline, "DEADLINE_PROBE_RATE", 0.0)
+    return result
+
+
+def plan_with_budget(seconds, params=PARAMS):
+    token = deadline._deadline.set(time.monotonic() + deadline.DEADLINE_MARGIN + seconds)
+    try:
+        return deadline.plan("test", params)
+    finally:
+        deadline._deadline.reset(token)
+
+
+# 没有样本时按先验（0.8s 首 token）会拒绝 0.5s 的预算；应当放行，让估计器拿到第一个样本
+def test_unlearned_model_is_not_rejected_by_priors(estimator):
+    assert plan_with_budget(0.5) == ("test", PARAMS)
+
+    # 实际比先验快得多：学到之后 1s 就够生成 400 token
+    estimator.record("test-model", 0.3, 200, ttft=0.1)
+    assert plan_with_budget(1.0) == ("test", PARAMS)
+
+
+def test_learned_slow_model_trims_then_rejects(estimator):
+    estimator.record("test-model", 2.0, 100, ttft=1.0)
+    provider, params = plan_with_budget(2.0)
+    assert provider == "test" and 90 <= params["max_tokens"] <= 100
+    with pytest.raises(DeadlineExceeded):
+        plan_with_budget(1.2)
+
+
+# 估计不够时按比例放行探测请求，悲观的估计还能被新样本纠正
+def test_probe_lets_request_through(estimator, monkeypatch):
+    estimator.record("test-model", 2.0, 100, ttft=1.0)
+    monkeypatch.setattr(deadline, "DEADLINE_PROBE_RATE", 1.0)
+    assert plan_with_budget(1.2) == ("test", PARAMS)
@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import admission
+import deadline
+import history_manager
+from history_manager import HistoryManager, prefix_digests
+
+MODEL = "meta-llama-3.1-8b-instruct"  # keep_lines=16
+
+
+def lines(count, width=10):
+    return [f"L{i}: " + "x" * width for i in range(count)]
+
+
+def test_short_history_is_sent_as_is():
+    history = lines(5)
+    assert HistoryManager().window(history, "chatai", MODEL) == (None, history)
+
+
+# 最新的摘要还没算好时退回更早的摘要，中间的行不能丢
+def test_older_summary_keeps_lines_after_it():
+    manager = HistoryManager()
+    history = lines(30)
+    digests = prefix_digests(history)
+    manager._summaries[digests[12]] = "S12"
+    summary, recent = manager.window(history, "chatai", MODEL)
+    assert summary.endswith("S12")
+    assert recent == history[12:]
+
+    manager._summaries[digests[18]] = "S18"
+    summary, recent = manager.window(history, "chatai", MODEL)
+    assert summary.endswith("S18")
+    assert recent == history[18:]
+
+
+# 更早的摘要加上之后的原文超出 token 预算时不带摘要，只发最近的窗口
+def test_older_summary_over_budget_falls_back_to_window():
+    manager = HistoryManager()
+    history = lines(30, width=600)
+    manager._summaries[prefix_digests(history)[6]] = "S6"
+    summary, recent = manager.window(history, "chatai", MODEL)
+    assert summary is None
+    assert recent == history[-len(recent):]
+    assert sum(history_manager.count_tokens(line) for line in recent) <= history_manager.HISTORY_BUDGETS[MODEL].max_tokens
+
+
+# 后台摘要不继承触发它的请求的截止时间与会话
+def test_summary_runs_outside_request_context(monkeypatch):
+    seen = []
+
+    async def chat_completion(provider, **params):
+        seen.append((deadline.remaining(), admission._session.get()))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="summary"))])
+
+    monkeypatch.setattr(history_manager.llm_client, "chat_completion", chat_completion)
+    manager = HistoryManager()
+    history = lines(30)
+
+    async def run():
+        deadline.start([(deadline.DEADLINE_HEADER, b"50")])
+        admission._session.set("s1")
+        manager.window(history, "chatai", MODEL)
+        await asyncio.gather(*manager._pending.values())
+
+    asyncio.run(run())
+    assert seen and all(item == (None, None) for item in seen)
+    assert manager._summaries[prefix_digests(history)[30]] == "summary"
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from json_extract import JsonArrayStreamParser, extract_dialogue
+
+REPLY = [
+    {"speaker": "Benji", "text": "Sounds {good}! \"yes\", [really]", "emotion": "happy", "gesture": "thumbsUp"},
+    {"speaker": "Caden", "text": "Agreed.", "emotion": "calm", "gesture": "clapping"},
+]
+
+
+# 按不同块大小逐块喂入：每个对象的右花括号一到就返回
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64])
+def test_streaming_parser_fed_in_chunks(chunk_size):
+    text = "```json\n" + json.dumps(REPLY, ensure_ascii=False) + "\n```"
+    parser = JsonArrayStreamParser()
+    items = []
+    for start in range(0, len(text), chunk_size):
+        items += parser.feed(text[start:start + chunk_size])
+    items += parser.finish()
+    assert items == REPLY
+
+
+def test_first_object_is_returned_before_the_array_ends():
+    parser = JsonArrayStreamParser()
+    text = json.dumps(REPLY)
+    assert parser.feed(text[:text.index("}, ") + 1]) == [REPLY[0]]
+
+
+def test_trailing_commas_are_tolerated():
+    text = '[{"speaker": "Benji", "text": "hi", "emotion": "happy", "gesture": "laughing",},]'
+    assert extract_dialogue(text) == [{"speaker": "Benji", "text": "hi", "emotion": "happy", "gesture": "laughing"}]
+
+
+def test_truncated_tail_keeps_complete_fields():
+    text = '[{"speaker": "Benji", "text": "hi", "emotion": "happy"}, {"speaker": "Caden", "text": "Well, I thi'
+    assert extract_dialogue(text) == [
+        {"speaker": "Benji", "text": "hi", "emotion": "happy"},
+        {"speaker": "Caden"},
+    ]
+
+
+def test_truncated_after_a_complete_value():
+    assert extract_dialogue('[{"speaker": "Caden", "text": "ok"') == [{"speaker": "Caden", "text": "ok"}]
+
+
+def test_preamble_and_non_object_arrays_are_skipped():
+    text = 'Here you go [note] and []:\n[{"speaker": "Benji", "text": "hi"}]'
+    assert extract_dialogue(text) == [{"speaker": "Benji", "text": "hi"}]
+
+
+def test_structured_output_wrapper():
+    assert extract_dialogue(json.dumps({"dialogue": REPLY})) == REPLY
+
+
+def test_no_array_returns_none():
+    assert extract_dialogue("I cannot answer that.") is None
+    assert extract_dialogue('{"speaker": "Benji"}') is None
+    assert extract_dialogue("[]") == []
@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+
+import pytest
+
+import colive_server_chatai
+import colive_server_chatai_sessionid
+from prompt_cache import prompt_cache
+
+
+# 每个会话不同的 prompt 尾部不进共享缓存：会话再多也只缓存一份静态前缀
+@pytest.mark.parametrize("server", [colive_server_chatai, colive_server_chatai_sessionid])
+def test_session_prompts_do_not_fill_the_cache(server):
+    prompt_cache.clear()
+    prompts = []
+    for i in range(20):
+        dialogue = SimpleNamespace(
+            session_id=f"s{i}", avatars=["Alice", "Benji", "Caden"], participant_role="Alice", history=[], user_input="hi"
+        )
+        prompts.append(server.build_messages(dialogue)[0]["content"])
+    assert prompt_cache.stats()["size"] == 1
+    static = server.build_system_prompt(["Alice", "Benji", "Caden"])
+    assert all(prompt.startswith(static) and "session ID: s" in prompt[len(static):] for prompt in prompts)
@@ -0,0 +1,99 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+import retries
+from retries import RetryBudget
+
+
+def status_error(status, headers=None):
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    return openai.APIStatusError("upstream error", response=httpx.Response(status, headers=headers, request=request), body=None)
+
+
+@pytest.fixture
+def no_delay(monkeypatch):
+    monkeypatch.setattr(retries, "RETRY_BASE_DELAY", 0.0)
+    monkeypatch.setattr(retries, "RETRY_MAX_ATTEMPTS", 3)
+
+
+def failing(calls, error):
+    async def fn():
+        calls.append(1)
+        raise error
+    return fn
+
+
+def test_retryable_error_is_retried_until_success(no_delay, monkeypatch):
+    monkeypatch.setitem(retries._budgets, "test", RetryBudget("test", ratio=0, initial=10))
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise status_error(429)
+        return "ok"
+
+    assert asyncio.run(retries.call("test", flaky)) == "ok"
+    assert len(calls) == 3
+
+
+def test_attempts_are_capped(no_delay, monkeypatch):
+    monkeypatch.setitem(retries._budgets, "test", RetryBudget("test", ratio=0, initial=10))
+    calls = []
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(retries.call("test", failing(calls, status_error(503))))
+    assert len(calls) == 3
+
+
+# 共享额度用完后不再重试：故障期间的重试量受额度限制
+def test_retries_stop_when_the_budget_is_spent(no_delay, monkeypatch):
+    bucket = RetryBudget("test", ratio=0, initial=1)
+    monkeypatch.setitem(retries._budgets, "test", bucket)
+    calls = []
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(retries.call("test", failing(calls, status_error(503))))
+    assert len(calls) == 2
+    assert bucket.balance == 0
+
+    calls.clear()
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(retries.call("test", failing(calls, status_error(503))))
+    assert len(calls) == 1
+
+
+def test_budget_refills_from_requests():
+    bucket = RetryBudget("test", ratio=0.5, initial=0, maximum=1)
+    assert not bucket.withdraw()
+    bucket.deposit()
+    bucket.deposit()
+    bucket.deposit()
+    assert bucket.balance == 1
+    assert bucket.withdraw()
+
+
+def test_non_retryable_errors_are_not_retried(no_delay, monkeypatch):
+    monkeypatch.setitem(retries._budgets, "test", RetryBudget("test", ratio=0, initial=10))
+    calls = []
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(retries.call("test", failing(calls, status_error(400))))
+    assert len(calls) == 1
+
+
+# 上游要求的等待超过 RETRY_MAX_DELAY 时直接放弃
+def test_long_retry_after_is_not_waited_for(no_delay, monkeypatch):
+    monkeypatch.setitem(retries._budgets, "test", RetryBudget("test", ratio=0, initial=10))
+    calls = []
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(retries.call("test", failing(calls, status_error(429, {"retry-after": "30"}))))
+    assert len(calls) == 1
+
+
+def test_classify():
+    assert retries.classify(status_error(429)) == "rate_limited"
+    assert retries.classify(status_error(502)) == "server_error"
+    assert retries.classify(status_error(400)) is None
+    assert retries.classify(status_error(503, {"x-should-retry": "false"})) is None
+    assert retries.retry_after(status_error(429, {"retry-after-ms": "1500"})) == 1.5
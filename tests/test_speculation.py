@@ -0,0 +1,74 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import colive_autotalk_server as server
+from speculation import SpeculationBuffer
+
+AVATARS = ["Alice", "Benji", "Caden"]
+
+
+def fake_response(speaker, text):
+    content = json.dumps([{"speaker": speaker, "text": text, "emotion": "neutral", "gesture": "start talking"}])
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+# 三个不带 session_id、角色相同的会话交替推进：每个会话的预测结果只给自己用
+def test_interleaved_sessions_without_session_id(monkeypatch):
+    calls = []
+
+    async def complete(messages, speaker):
+        calls.append(speaker)
+        return fake_response(speaker, f"reply {len(calls)}")
+
+    buffer = SpeculationBuffer()
+    monkeypatch.setattr(server, "complete", complete)
+    monkeypatch.setattr(server, "speculation", buffer)
+    monkeypatch.setattr(server, "SPECULATE", True)
+
+    async def run():
+        histories = [[], [], []]
+        for turn_id in range(4):
+            for history in histories:
+                dialogue = server.DialogueRequest(
+                    user_input="", history=list(history), avatars=AVATARS, participant_role="Alice", turn_id=turn_id
+                )
+                result = await server.generate_response(dialogue)
+                history.extend(f"{item['speaker']}: {item['text']}" for item in result["dialogue"])
+                await asyncio.sleep(0)
+        return histories
+
+    histories = asyncio.run(run())
+
+    assert all(len(history) == 4 for history in histories)
+    assert buffer.hits == 9
+    assert buffer.invalidated == 0
+    # 每个会话第一轮直接生成，之后每轮都命中；每次返回后都会预生成下一轮
+    assert len(calls) == 3 + 12
+
+
+# 带 session_id 时 history 分叉会作废旧的预测结果
+def test_diverged_history_invalidates(monkeypatch):
+    calls = []
+
+    async def complete(messages, speaker):
+        calls.append(speaker)
+        return fake_response(speaker, f"reply {len(calls)}")
+
+    buffer = SpeculationBuffer()
+    monkeypatch.setattr(server, "complete", complete)
+    monkeypatch.setattr(server, "speculation", buffer)
+    monkeypatch.setattr(server, "SPECULATE", True)
+
+    async def run():
+        first = server.DialogueRequest(
+            user_input="", history=[], avatars=AVATARS, participant_role="Alice", turn_id=0, session_id="s1"
+        )
+        await server.generate_response(first)
+        await asyncio.sleep(0)
+        diverged = first.model_copy(update={"history": ["Alice: something else"], "turn_id": 1})
+        await server.generate_response(diverged)
+
+    asyncio.run(run())
+    assert buffer.hits == 0
+    assert buffer.invalidated == 1
@@ -0,0 +1,55 @@
+from collections import defaultdict
+
+import metrics
+import structured_log
+
+
+# 按 (variant, model) 统计上游返回的 token 用量，cached_tokens 反映 prompt 前缀缓存的命中情况
+class UsageStats:
+    def __init__(self):
+        self._totals = defaultdict(lambda: {
+            "requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "cancelled": 0, "tokens_saved": 0,
+        })
+
+    def record(self, variant, model, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        prompt_tokens = usage.prompt_tokens or 0
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+        completion_tokens = usage.completion_tokens or 0
+        totals = self._totals[(variant, model)]
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["cached_tokens"] += cached_tokens
+        totals["completion_tokens"] += completion_tokens
+        metrics.tokens_total.inc(variant, model, "prompt", amount=prompt_tokens)
+        metrics.tokens_total.inc(variant, model, "cached", amount=cached_tokens)
+        metrics.tokens_total.inc(variant, model, "completion", amount=completion_tokens)
+        structured_log.add_usage(prompt_tokens, completion_tokens)
+
+    # 客户端断开后取消的生成：按该模型已完成请求的平均补全长度（没有样本时用 max_tokens）估计省下的 token
+    #   generated: 取消前已经收到的补全 token 数（流式按 chunk 计）
+    def record_cancelled(self, variant, model, generated=0, max_tokens=None):
+        totals = self._totals[(variant, model)]
+        if totals["requests"]:
+            expected = totals["completion_tokens"] / totals["requests"]
+        else:
+            expected = max_tokens or 0
+        saved = max(0, round(expected) - generated)
+        totals["cancelled"] += 1
+        totals["tokens_saved"] += saved
+        metrics.cancelled_total.inc(variant, model)
+        metrics.tokens_saved_total.inc(variant, model, amount=saved)
+
+    def stats(self):
+        result = {}
+        for (variant, model), totals in self._totals.items():
+            result[f"{variant}/{model}"] = {
+                **totals,
+                "cached_ratio": totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0,
+            }
+        return result
+
+
+usage_stats = UsageStats()